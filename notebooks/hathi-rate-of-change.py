@@ -7,11 +7,19 @@ app = marimo.App(width="medium")
 @app.cell
 def _():
     import pathlib
+    import sys
 
     import marimo as mo
     import polars as pl
 
-    return mo, pathlib, pl
+    # shared hathifile and data cache utilities are in the scripts directory
+    sys.path.append("scripts")
+    import data_cache
+    import hathi_deletions
+    import hathi_update_counts
+    import hathifiles
+
+    return data_cache, hathi_deletions, hathi_update_counts, hathifiles, mo, pathlib, pl
 
 
 @app.cell
@@ -24,29 +32,23 @@ def _(pathlib):
 
 
 @app.cell
-def _(field_list, hathi_data_dir, pl):
-    # load most recent full dataset with specified field list; treat as TSV
-
-    df = (
-        pl.scan_csv(
-            hathi_data_dir / "hathi_full_20250701.txt.gz",
-            has_header=False,
-            new_columns=field_list,
-            separator="\t",
-            quote_char=None,  # do not treat " as escape character, since it is used in some content
-            encoding="utf8",
-        )
-        .select(["htid", "access", "rights", "collection_code", "access_profile_code"])
-        .collect()
-    )
+def _(data_cache, field_list, hathi_data_dir, hathifiles):
+    # load most recent full dataset with specified field list, lazily, from a
+    # columnar snapshot cache (built from the gzip TSV the first time);
+    # links the file from the shared data cache if it is not in this checkout
 
-    df.head(10)
+    df = hathifiles.scan_snapshot(
+        data_cache.resolve(hathi_data_dir / "hathi_full_20250701.txt.gz"), field_list
+    ).select(["htid", "access", "rights", "collection_code", "access_profile_code"])
+
+    df.head(10).collect()
     return (df,)
 
 
 @app.cell
-def _(df):
-    total_ht_vols = df.height
+def _(df, pl):
+    # row count comes from parquet metadata, without reading any data
+    total_ht_vols = df.select(pl.len()).collect().item()
 
     print(f"{total_ht_vols:,} total volumes")
     return (total_ht_vols,)
@@ -54,19 +56,19 @@ def _(df):
 
 @app.cell
 def _(df):
-    df["rights"].value_counts()
+    df.group_by("rights").len(name="count").sort("count", descending=True).collect()
     return
 
 
 @app.cell
 def _(df):
-    df["access"].value_counts()
+    df.group_by("access").len(name="count").sort("count", descending=True).collect()
     return
 
 
 @app.cell
 def _(df):
-    df["access_profile_code"].value_counts()
+    df.group_by("access_profile_code").len(name="count").sort("count", descending=True).collect()
     return
 
 
@@ -90,59 +92,22 @@ def _(pl):
 
 
 @app.cell
-def _(field_list, hathi_data_dir, pl, ppa_ht_df):
-    import datetime
-
-    from polars.exceptions import NoDataError
-
-    update_data = []
-
-    for update_file in hathi_data_dir.glob("hathi_upd_*.txt.gz"):
-        update_date_str = update_file.stem.rsplit("_")[-1].replace(".txt", "")
-        update_date = datetime.datetime.strptime(update_date_str, "%Y%m%d").date()
-
-        # at least one file is actually empty; handle the error and skip
-        try:
-            update_df = (
-                pl.scan_csv(
-                    update_file,
-                    has_header=False,
-                    new_columns=field_list,
-                    separator="\t",
-                    quote_char=None,  # do not treat " as escape character, since it is used in smoe content
-                    encoding="utf8",
-                )
-                .select(["htid"])  # , "access", "rights", "collection_code"])
-                .collect()
-            )
-            # join with ppa data so we can count # ppa volumes that changed
-            ppa_updates_df = update_df.join(
-                ppa_ht_df, left_on="htid", right_on="ppa_source_id", how="inner"
-            )
-
-            update_data.append(
-                {
-                    "date": update_date,
-                    "num_updated": update_df.height,
-                    "ppa_updated": ppa_updates_df.height,
-                }
-            )
-        except NoDataError as err:
-            print(f"Error parsing {update_file.name} : {err}")
-    return datetime, update_data
+def _(field_list, hathi_data_dir, hathi_update_counts, ppa_ht_df):
+    # count all updated volumes and ppa volumes in each update file; files are
+    # counted in parallel in separate processes, and results are sorted by date
+    update_data = hathi_update_counts.compute_update_counts(
+        sorted(hathi_data_dir.glob("hathi_upd_*.txt.gz")),
+        ppa_ht_df.select("ppa_source_id"),
+        field_list,
+    )
+    return (update_data,)
 
 
 @app.cell
-def _(pl, ppa_ht_total, total_ht_vols, update_data):
-    update_data_df = pl.from_dicts(update_data)
-    update_data_df = (
-        # calculate percentages for all of hathitrust and then all of ppa
-        update_data_df.with_columns(
-            pct_updated=pl.col("num_updated").truediv(total_ht_vols),
-            pct_ppa_updated=pl.col("ppa_updated").truediv(ppa_ht_total),
-        )
-        .cast({"date": pl.Date})
-        .sort("date")
+def _(hathi_update_counts, ppa_ht_total, total_ht_vols, update_data):
+    # calculate percentages for all of hathitrust and then all of ppa
+    update_data_df = hathi_update_counts.add_percentages(
+        update_data, total_ht_vols, ppa_ht_total
     )
     update_data_df
     return (update_data_df,)
@@ -346,31 +311,26 @@ def _(mo):
 
 
 @app.cell
-def _(datetime, pathlib, pl, total_ht_vols):
+def _(hathi_deletions, pathlib, pl, total_ht_vols):
     hathi_deletion_dir = pathlib.Path("data/hathi/deletions")
 
-    deletion_count = []
-
-    start_str = "===BEGIN ID LIST==="
-    end_str = "===END ID LIST==="
-
-    for deletion_email in hathi_deletion_dir.glob("*.txt"):
-        deletion_date = datetime.datetime.strptime(
-            deletion_email.stem, "%Y-%m-%d"
-        ).date()
-        contents = deletion_email.open().read()
-        # use begin/end strings to isolate content of interest
-        deleted_id_list = contents.split(start_str)[1].split(end_str)[0]
-        # split on newlines and filter out any empty strings
-        deleted_ids = [id for id in deleted_id_list.split("\n") if id.strip() != ""]
-        deletion_count.append({"date": deletion_date, "count": len(deleted_ids)})
-
-    deletion_df = (
-        pl.from_dicts(deletion_count)
-        .sort("date")
-        .with_columns(percent=pl.col("count").truediv(total_ht_vols))
+    # add any new deletion notices to the deleted htid store; notices already in the store are skipped
+    deletion_store = hathi_deletions.DeletionStore()
+    for deletion_email in sorted(hathi_deletion_dir.glob("*.txt")):
+        deletion_store.ingest(deletion_email)
+
+    # number of ids listed in each notice, by date
+    deletion_df = deletion_store.notice_counts().with_columns(
+        percent=pl.col("count").truediv(total_ht_vols)
     )
     deletion_df
+    return (deletion_store,)
+
+
+@app.cell
+def _(deletion_store):
+    # PPA volumes that have been removed from the public domain dataset
+    deletion_store.join_ppa()
     return
 
 
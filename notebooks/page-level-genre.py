@@ -6,9 +6,16 @@ app = marimo.App(width="medium", auto_download=["ipynb"])
 
 @app.cell
 def _():
+    import sys
+
     import marimo as mo
     import polars as pl
-    return mo, pl
+
+    # htid and filename conversion is in the scripts directory
+    sys.path.append("scripts")
+    import htid_paths
+
+    return htid_paths, mo, pl
 
 
 @app.cell
@@ -146,7 +153,7 @@ def _(mo):
 
 
 @app.cell
-def _(pl, ppa_ht_df):
+def _(htid_paths, pl, ppa_ht_df):
     # ppa work ids for three test cases of interest
     test_cases = [
         "njp.32101068158847-p223",
@@ -158,7 +165,17 @@ def _(pl, ppa_ht_df):
 
     ppa_test_cases = ppa_ht_df.filter(
         pl.col("ppa_work_id").is_in(test_cases)
-    ).select("ppa_work_id", "ppa_source_id", "ppa_work_title", "ppa_work_year")
+    ).select(
+        "ppa_work_id",
+        "ppa_source_id",
+        "ppa_work_title",
+        "ppa_work_year",
+        # page-level genre data is in a json file named based on the clean hathi id
+        # (ARKs and other ids with : or / in them are changed to be valid filenames)
+        genre_file=pl.concat_str(
+            htid_paths.clean_htid(pl.col("ppa_source_id")), pl.lit(".json")
+        ),
+    )
     ppa_test_cases
     return (ppa_test_cases,)
 
@@ -177,9 +194,7 @@ def _(ppa_test_cases):
     for row in ppa_test_cases.iter_rows(named=True):
         print(f"\n{row['ppa_work_id']} : {row['ppa_work_title']}")
 
-        # page-level genre data is in a json file named based on the hathi id
-        # current test sets don't include any ARKs; if we expand, translate ids to filenames
-        with open(all1700_dir / f"{row['ppa_source_id']}.json") as jsonfile:
+        with open(all1700_dir / row["genre_file"]) as jsonfile:
             genre_data = json.load(jsonfile)
 
         # display summary information
@@ -7,12 +7,20 @@ app = marimo.App(width="medium")
 @app.cell
 def _():
     import pathlib
+    import sys
 
     import altair as alt
     import marimo as mo
     import polars as pl
 
-    return alt, mo, pathlib, pl
+    # shared data cache and corpus utilities are in the scripts directory
+    sys.path.append("scripts")
+    import data_cache
+    import htid_paths
+    import page_edits
+    import ppa_corpus
+
+    return alt, data_cache, htid_paths, mo, page_edits, pathlib, pl, ppa_corpus
 
 
 @app.cell(hide_code=True)
@@ -32,18 +40,19 @@ def _(mo):
 
 
 @app.cell
-def _(pathlib, pl):
+def _(data_cache, pathlib, ppa_corpus):
     PPA_DATA_DIR = pathlib.Path("data/ppa/")
 
-    ppa_corpus_newer = pl.read_ndjson(
-        PPA_DATA_DIR / "ppa_corpus_2025-02-19/ppa_pages.jsonl.gz"
-    )
-    # limit to HathiTrust content only, based on source id; non-hathi ids have known patterns
-    ppa_corpus_newer = ppa_corpus_newer.filter(
-        # EEBO-TPC work id is A followed by numbers
-        # Gale/ECCO work id is CW/CB followed by numbers
-        # both could have an optional -p## for excerpt start page
-        ~pl.col("work_id").str.contains(r"^((A\d+)|(C[WB]\d+))(-p.+)?$")
+    # corpus exports are linked from the shared data cache if not in this checkout,
+    # unless they have been converted to datasets partitioned by source (see ppa_corpus.py);
+    # limit to HathiTrust content only, based on work id (non-hathi ids have known patterns),
+    # filtering each batch of pages as the file is read, or reading only the HathiTrust files. Page text is only needed for
+    # comparison, so keep a 64-bit hash of each page's text instead of the text itself
+    ppa_corpus_newer = ppa_corpus.read_pages(
+        data_cache.resolve(ppa_corpus.corpus_path(PPA_DATA_DIR / "ppa_corpus_2025-02-19/ppa_pages.jsonl.gz")),
+        columns=["id", "work_id"],
+        source="HathiTrust",
+        hash_bits=64,
     )
 
     ppa_corpus_newer.head(10)
@@ -51,13 +60,13 @@ def _(pathlib, pl):
 
 
 @app.cell
-def _(PPA_DATA_DIR, pl):
-    ppa_corpus_frozen = pl.read_ndjson(
-        PPA_DATA_DIR / "ppa_corpus_2025-02-03_1308/ppa_pages.jsonl.gz"
-    )
-    ppa_corpus_frozen = ppa_corpus_frozen.with_columns(
-        work_id_prefix=pl.col("work_id").str.slice(0, 2)
-    ).filter(~pl.col("work_id").str.contains(r"^((A\d+)|(C[WB]\d+))(-p.+)?$"))
+def _(PPA_DATA_DIR, data_cache, pl, ppa_corpus):
+    ppa_corpus_frozen = ppa_corpus.read_pages(
+        data_cache.resolve(ppa_corpus.corpus_path(PPA_DATA_DIR / "ppa_corpus_2025-02-03_1308/ppa_pages.jsonl.gz")),
+        columns=["id", "work_id"],
+        source="HathiTrust",
+        hash_bits=64,
+    ).with_columns(work_id_prefix=pl.col("work_id").str.slice(0, 2))
 
     ppa_corpus_frozen.head()
     return (ppa_corpus_frozen,)
@@ -122,9 +131,11 @@ def _(mo):
 
 @app.cell
 def _(pl, ppa_corpus_frozen, ppa_corpus_newer):
+    # compare text by hash; as when comparing the text itself, text_equal is null
+    # when either page has null text
     pageid_join = ppa_corpus_frozen.join(
         ppa_corpus_newer, on="id", how="inner"
-    ).with_columns(text_equal=pl.col("text").eq(pl.col("text_right")))
+    ).with_columns(text_equal=pl.col("text_hash").eq(pl.col("text_hash_right")))
 
     pageid_join.head(10)
     return (pageid_join,)
@@ -144,12 +155,38 @@ def _(mo, pageid_join, pl):
     return
 
 
+@app.cell(hide_code=True)
+def _(mo):
+    mo.md(r"""For pages where the text changed, how much did it change?""")
+    return
+
+
+@app.cell
+def _(PPA_DATA_DIR, mo, page_edits, pl):
+    # character and word-level edit statistics for each changed page take a while
+    # to compute, so they are computed ahead of time with:
+    # python ./scripts/page_edits.py data/ppa/ppa_corpus_2025-02-03_1308/ppa_pages.jsonl.gz \
+    #     data/ppa/ppa_corpus_2025-02-19/ppa_pages.jsonl.gz -o data/ppa/ppa_page_edits_2025-02-03_2025-02-19.parquet
+    page_edits_file = PPA_DATA_DIR / "ppa_page_edits_2025-02-03_2025-02-19.parquet"
+    mo.stop(
+        not page_edits_file.exists(),
+        mo.md(f"No edit statistics; run `scripts/page_edits.py` to save them to `{page_edits_file}`"),
+    )
+
+    work_edits = page_edits.work_summary(pl.scan_parquet(page_edits_file)).collect()
+    work_edits.sort("mean_similarity")
+    return
+
+
 @app.cell
 def _(pl, ppa_corpus_newer):
     # how many pages are null? 38,505
-    # ppa_corpus_202404.filter(pl.col("text").is_null())
     # how many are empty string? 12,469
-    ppa_corpus_newer.filter(pl.col("text").str.strip_chars().eq(""))
+    # null text has no hash; empty pages are null or only whitespace
+    ppa_corpus_newer.select(
+        null=pl.col("text_hash").is_null().sum(),
+        empty_string=(pl.col("empty") & pl.col("text_hash").is_not_null()).sum(),
+    )
     return
 
 
@@ -157,15 +194,12 @@ def _(pl, ppa_corpus_newer):
 def _(pl, ppa_corpus_frozen, ppa_corpus_newer):
     # what if we join on exact text?
     # DUH filter out empty pages so they don't all match each other
-    # join on matching page and same work id
+    # join on matching page text hash and same work id
     pagetext_join = (
-        ppa_corpus_frozen.filter(~pl.col("text").is_null())
-        .filter(~pl.col("text").str.strip_chars().eq(""))
+        ppa_corpus_frozen.filter(~pl.col("empty"))
         .join(
-            ppa_corpus_newer.filter(~pl.col("text").is_null()).filter(
-                ~pl.col("text").str.strip_chars().eq("")
-            ),
-            on=["text", "work_id"],
+            ppa_corpus_newer.filter(~pl.col("empty")),
+            on=["text_hash", "work_id"],
             how="inner",
         )
         .with_columns(id_equal=pl.col("id").eq(pl.col("id_right")))
@@ -196,29 +230,14 @@ def _(mo):
 
 
 @app.cell
-def _(pathlib, pl):
-    from pairtree import path2id
-
-    def path_to_htid(filepath):
-        filepath = pathlib.Path(filepath)
-        prefix = filepath.parts[0]
-        return f"{prefix}.{path2id(filepath.stem.rsplit('.')[0])}"
-
-    def path_suffixes(filepath):
-        filepath = pathlib.Path(filepath)
-        return "".join(filepath.suffixes)
-
+def _(htid_paths, pl):
     lastmod_df = pl.read_csv(
         "data/ppa/ppa_htfiles_lastmod.csv",
         schema_overrides={"last_modified": pl.datatypes.Datetime},
     ).with_columns(
         last_mod_day=pl.col("last_modified").cast(pl.datatypes.Date),
-        htid=pl.col("filename").map_elements(
-            path_to_htid, return_dtype=pl.datatypes.String
-        ),
-        file_type=pl.col("filename").map_elements(
-            path_suffixes, return_dtype=pl.datatypes.String
-        ),
+        htid=htid_paths.path_htid(pl.col("filename")),
+        file_type=htid_paths.path_suffix(pl.col("filename")),
     )
 
     lastmod_mets_df = lastmod_df.filter(pl.col("file_type").eq(".mets.xml"))
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+Content-addressed local cache for large data files (hathifiles, PPA
+corpus exports), shared by all checkouts of this repository on a machine.
+
+Each file is stored once in the cache directory, named by its SHA-256
+checksum, and hardlinked into a checkout's `data/` directory (reflinked or,
+as a last resort, copied when the cache is on a different filesystem).
+Files are also recorded by their path relative to `data/`, so a fresh
+checkout can be populated from the cache without downloading anything.
+
+Cached files are made read-only, since a hardlinked copy shares its content
+with the cache. When a size budget is set, the least recently used files
+are evicted until the cache fits; disk space for an evicted file is only
+freed once no checkout links to it.
+
+The cache location defaults to `~/.cache/chr2025-unstable-data`; set
+`CHR2025_DATA_CACHE` to use a shared directory instead.
+"""
+
+import argparse
+import fcntl
+import hashlib
+import os
+import pathlib
+import shutil
+import sqlite3
+import time
+
+DATA_DIR = pathlib.Path(__file__).parent.parent.resolve() / "data"
+
+CACHE_DIR = pathlib.Path(
+    os.environ.get(
+        "CHR2025_DATA_CACHE",
+        pathlib.Path(os.environ.get("XDG_CACHE_HOME", "~/.cache")) / "chr2025-unstable-data",
+    )
+).expanduser()
+
+# linux ioctl to clone file contents on copy-on-write filesystems (btrfs, xfs)
+FICLONE = 0x40049409
+
+SIZE_UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def parse_size(value: str) -> int:
+    """Parse a size with an optional K/M/G/T suffix, e.g. `50G`."""
+    value = value.strip().upper().removesuffix("B")
+    if value and value[-1] in SIZE_UNITS:
+        return int(float(value[:-1]) * SIZE_UNITS[value[-1]])
+    return int(value)
+
+
+def file_checksum(filename: pathlib.Path) -> str:
+    """Calculate the SHA-256 checksum of a local file."""
+    with filename.open("rb") as filehandle:
+        return hashlib.file_digest(filehandle, "sha256").hexdigest()
+
+
+def link_file(src: pathlib.Path, dest: pathlib.Path) -> str:
+    """Put a copy of `src` at `dest` without duplicating content where possible:
+    hardlink, then reflink, then a regular copy. Replaces any existing
+    file at `dest`. Returns the method used."""
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dest = dest.with_name(f"{dest.name}.linktmp")
+    tmp_dest.unlink(missing_ok=True)
+    try:
+        os.link(src, tmp_dest)
+        method = "hardlink"
+    except OSError:
+        try:
+            with src.open("rb") as infile, tmp_dest.open("wb") as outfile:
+                fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+            method = "reflink"
+        except OSError:
+            shutil.copyfile(src, tmp_dest)
+            method = "copy"
+    tmp_dest.replace(dest)
+    return method
+
+
+class DataCache:
+    """Content-addressed file store with an sqlite index of files by
+    checksum (with size and last use) and by name."""
+
+    def __init__(self, cache_dir: pathlib.Path = CACHE_DIR, budget: int | None = None):
+        self.cache_dir = cache_dir
+        self.blob_dir = cache_dir / "sha256"
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+        self.budget = budget
+        # generous timeout, since several analysts may be using the cache at once
+        self.db = sqlite3.connect(cache_dir / "index.sqlite", timeout=60)
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS blobs (digest TEXT PRIMARY KEY, size INTEGER, last_used REAL)"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS refs (name TEXT PRIMARY KEY, digest TEXT, version TEXT)"
+            )
+
+    def blob_path(self, digest: str) -> pathlib.Path:
+        return self.blob_dir / digest[:2] / digest
+
+    def add(
+        self,
+        path: pathlib.Path,
+        name: str | None = None,
+        version: str | None = None,
+        digest: str | None = None,
+    ) -> str:
+        """Add a file to the cache and return its checksum. When `name` is
+        specified, record it as the current content for that name (and
+        optional upstream `version`). If the cache is on the same
+        filesystem, `path` is replaced with a link to the cached copy."""
+        digest = digest or file_checksum(path)
+        blob = self.blob_path(digest)
+        if not blob.exists():
+            link_file(path, blob)
+            blob.chmod(0o444)
+        blob_stat, path_stat = blob.stat(), path.stat()
+        if blob_stat.st_ino != path_stat.st_ino and blob_stat.st_dev == path_stat.st_dev:
+            # replace the original with a link to the cached copy, so content is stored once
+            link_file(blob, path)
+
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)",
+                (digest, blob.stat().st_size, time.time()),
+            )
+            if name is not None:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO refs VALUES (?, ?, ?)", (name, digest, version)
+                )
+        if self.budget is not None:
+            self.evict(self.budget, keep={digest})
+        return digest
+
+    def lookup(self, name: str, version: str | None = None) -> str | None:
+        """Find the checksum of the cached file for a name, if there is one
+        (and it matches `version`, when specified)."""
+        row = self.db.execute("SELECT digest, version FROM refs WHERE name = ?", (name,)).fetchone()
+        if row is None or (version is not None and row[1] != version):
+            return None
+        if not self.blob_path(row[0]).exists():
+            return None
+        return row[0]
+
+    def checkout(self, name: str, dest: pathlib.Path, version: str | None = None) -> str | None:
+        """Link the cached file for a name to `dest`. Returns the checksum,
+        or `None` if the file is not in the cache."""
+        digest = self.lookup(name, version)
+        if digest is None:
+            return None
+        link_file(self.blob_path(digest), dest)
+        with self.db:
+            self.db.execute("UPDATE blobs SET last_used = ? WHERE digest = ?", (time.time(), digest))
+        return digest
+
+    def total_size(self) -> int:
+        return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+
+    def evict(self, budget: int, keep: set[str] | None = None) -> list[str]:
+        """Remove least recently used files until the cache is within
+        `budget` bytes. Returns the checksums of evicted files."""
+        keep = keep or set()
+        evicted = []
+        total = self.total_size()
+        for digest, size in self.db.execute("SELECT digest, size FROM blobs ORDER BY last_used").fetchall():
+            if total <= budget:
+                break
+            if digest in keep:
+                continue
+            self.blob_path(digest).unlink(missing_ok=True)
+            with self.db:
+                self.db.execute("DELETE FROM blobs WHERE digest = ?", (digest,))
+                self.db.execute("DELETE FROM refs WHERE digest = ?", (digest,))
+            total -= size
+            evicted.append(digest)
+        return evicted
+
+
+def data_name(path: pathlib.Path, data_dir: pathlib.Path = DATA_DIR) -> str:
+    """Name used in the cache for a data file: its path relative to `data/`."""
+    return path.resolve().relative_to(data_dir.resolve()).as_posix()
+
+
+def resolve(path: str | pathlib.Path, data_dir: pathlib.Path = DATA_DIR) -> pathlib.Path:
+    """Return the path to a data file, linking it in from the cache
+    first if it is not present in this checkout."""
+    path = pathlib.Path(path)
+    if not path.exists():
+        DataCache().checkout(data_name(path, data_dir), path)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the shared local cache of data files")
+    parser.add_argument("--cache-dir", type=pathlib.Path, default=CACHE_DIR, help="Cache directory (default: %(default)s)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    add_parser = subparsers.add_parser("add", help="Add data files to the cache")
+    add_parser.add_argument("files", type=pathlib.Path, nargs="+")
+    checkout_parser = subparsers.add_parser("checkout", help="Link cached files into data/")
+    checkout_parser.add_argument("names", nargs="*", help="Names (paths relative to data/); default all")
+    evict_parser = subparsers.add_parser("evict", help="Evict least recently used files")
+    evict_parser.add_argument("budget", type=parse_size, help="Size budget, e.g. 50G")
+    subparsers.add_parser("status", help="Summarize cache contents")
+    args = parser.parse_args()
+
+    cache = DataCache(args.cache_dir)
+    if args.command == "add":
+        for path in args.files:
+            digest = cache.add(path, data_name(path))
+            print(f"{data_name(path)} {digest}")
+    elif args.command == "checkout":
+        names = args.names or [row[0] for row in cache.db.execute("SELECT name FROM refs ORDER BY name")]
+        for name in names:
+            dest = DATA_DIR / name
+            if dest.exists():
+                continue
+            if cache.checkout(name, dest):
+                print(f"Linked {name}")
+            else:
+                print(f"{name} is not in the cache")
+    elif args.command == "evict":
+        evicted = cache.evict(args.budget)
+        print(f"Evicted {len(evicted)} files; cache is now {cache.total_size() / SIZE_UNITS['G']:.1f} GB")
+    elif args.command == "status":
+        num_files = cache.db.execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
+        print(f"{num_files:,} files, {cache.total_size() / SIZE_UNITS['G']:.1f} GB in {cache.cache_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+"""
+Propose new digital page ranges for PPA excerpts when HathiTrust
+reprocesses a volume and its pages shift, instead of finding each new
+range by hand (as in `data/ppa/excerpts-2023-09-20.csv`).
+
+For each excerpt, the pages in its old digital range are matched by
+content against every page of the new version of the volume. Pages are
+compared as sets of word shingles (see `near_duplicates.py`), so pages
+match even when the text was re-OCRed, and each old page keeps its best
+few matches. The matches that form the best ordered alignment (old and new
+page numbers both increasing, with the highest total similarity) are
+used to map the start and end of the range; an end page without a match is
+placed relative to the nearest aligned page. Ranges with several spans
+(e.g. `202-204, 317-318`) are mapped one span at a time. The confidence
+score is the total similarity of the aligned pages over the number of
+old pages with text, so 1.0 means every page was found unchanged.
+
+Old and new versions of a volume can be read from a PPA corpus export
+(`ppa_pages.jsonl.gz`) or from a local copy of HathiTrust data in pairtree
+layout (`{prefix}/pairtree_root/.../{id}/{id}.zip`). Volumes are
+processed in parallel.
+
+Run as a script to propose ranges for a spreadsheet of excerpts, and to
+check them against the `new digital range` column when there is one.
+"""
+
+import argparse
+import os
+import pathlib
+import re
+import zipfile
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import polars as pl
+from intspan import intspan
+
+from htid_paths import htid_path
+from near_duplicates import DEFAULT_SHINGLE_SIZE
+from ppa_corpus import DEFAULT_BATCH_SIZE, iter_pages
+
+EXCERPTS_FILE = pathlib.Path(__file__).parent.parent.resolve() / "data" / "ppa" / "excerpts-2023-09-20.csv"
+
+#: minimum similarity for two pages to be considered a match
+DEFAULT_MIN_SIMILARITY = 0.3
+#: number of candidate matches kept for each old page
+CANDIDATES = 3
+#: confidence levels reported when validating
+CONFIDENCE_LEVELS = [0.5, 0.8, 0.9]
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+#: page sequence number from a page text filename in a HathiTrust zip file
+PAGE_FILENAME = re.compile(r"(\d+)\.txt$")
+
+#: pairtree data directories, set in each worker process
+_pairtrees: dict[str, pathlib.Path] = {}
+
+
+def volume_id(work_id: pl.Expr) -> pl.Expr:
+    """Expression for the HathiTrust volume id of a work, without the
+    `-p##` suffix used for excerpts."""
+    return work_id.str.replace(r"-p[^-]+$", "")
+
+
+def read_volumes(corpus_file: pathlib.Path, htids: set[str], batch_size: int = DEFAULT_BATCH_SIZE) -> dict:
+    """Read pages for a set of volumes from a corpus export, as a dict of
+    htid → {page order: text}. Pages from excerpts of the same volume are combined."""
+    volumes = {}
+    for pages_df in iter_pages(corpus_file, ["work_id", "order", "text"], "HathiTrust", batch_size):
+        pages_df = pages_df.with_columns(htid=volume_id(pl.col("work_id"))).filter(pl.col("htid").is_in(htids))
+        for htid, order, text in pages_df.select("htid", "order", "text").iter_rows():
+            volumes.setdefault(htid, {})[order] = text
+    return volumes
+
+
+def read_pairtree_volume(pairtree_dir: pathlib.Path, htid: str) -> dict[int, str] | None:
+    """Read pages for a volume from its text zip file in a local copy of
+    HathiTrust data, as a dict of page sequence number → text; None if
+    the volume is not there."""
+    zip_path = pairtree_dir / pl.select(htid_path(pl.lit(htid), "{id}.zip")).item()
+    if not zip_path.exists():
+        return None
+    pages = {}
+    with zipfile.ZipFile(zip_path) as zip_file:
+        for name in zip_file.namelist():
+            if match := PAGE_FILENAME.search(name):
+                pages[int(match.group(1))] = zip_file.read(name).decode("utf-8", errors="replace")
+    return pages
+
+
+def shingle_set(text: str | None, size: int = DEFAULT_SHINGLE_SIZE) -> frozenset:
+    """Set of overlapping word shingles in page text, case and punctuation
+    aside, matching `near_duplicates.shingles`."""
+    words = re.findall(r"\w+", (text or "").lower())
+    if not words:
+        return frozenset()
+    return frozenset(" ".join(words[i : i + size]) for i in range(max(len(words) - size + 1, 1)))
+
+
+def best_alignment(candidates: list[tuple[int, int, float]]) -> list[tuple[int, int, float]]:
+    """From candidate matches (old page, new page, similarity), choose the
+    ordered alignment with the highest total similarity: at most one match
+    per old page, and new pages increasing with old pages."""
+    candidates = sorted(candidates)
+    # best total similarity and previous match for an alignment ending with each candidate
+    totals = []
+    previous = []
+    for i, (old, new, similarity) in enumerate(candidates):
+        totals.append(similarity)
+        previous.append(None)
+        for j in range(i):
+            if candidates[j][0] < old and candidates[j][1] < new and totals[j] + similarity > totals[i]:
+                totals[i] = totals[j] + similarity
+                previous[i] = j
+    if not candidates:
+        return []
+    i = max(range(len(candidates)), key=totals.__getitem__)
+    alignment = []
+    while i is not None:
+        alignment.append(candidates[i])
+        i = previous[i]
+    return alignment[::-1]
+
+
+def remap_span(
+    start: int,
+    end: int,
+    old_pages: dict[int, str],
+    new_shingles: dict[int, frozenset],
+    shingle_index: dict[str, list[int]],
+    min_similarity: float = DEFAULT_MIN_SIMILARITY,
+    shingle_size: int = DEFAULT_SHINGLE_SIZE,
+) -> tuple[tuple[int, int] | None, float, int]:
+    """Map one span of old page numbers to the new version of a volume.
+    Returns the new (start, end) or None if no page could be matched, the
+    confidence score, and the number of aligned pages."""
+    candidates = []
+    pages_with_text = 0
+    for order in range(start, end + 1):
+        shingles = shingle_set(old_pages.get(order), shingle_size)
+        if not shingles:
+            continue
+        pages_with_text += 1
+        shared = Counter(new for shingle in shingles for new in shingle_index.get(shingle, []))
+        scores = [(count / len(shingles | new_shingles[new]), new) for new, count in shared.items()]
+        candidates.extend(
+            (order, new, similarity)
+            for similarity, new in sorted(scores, reverse=True)[:CANDIDATES]
+            if similarity >= min_similarity
+        )
+    alignment = best_alignment(candidates)
+    if not alignment:
+        return None, 0.0, 0
+    (first_old, first_new, _), (last_old, last_new, _) = alignment[0], alignment[-1]
+    last_page = max(new_shingles)
+    new_start = max(first_new - (first_old - start), 1)
+    new_end = min(last_new + (end - last_old), last_page)
+    confidence = sum(similarity for _, _, similarity in alignment) / pages_with_text
+    return (new_start, new_end), round(confidence, 3), len(alignment)
+
+
+def remap_volume(task: tuple) -> list[dict]:
+    """Propose new ranges for all excerpts from one volume. `task` is
+    (htid, [(excerpt index, pages_digital), ...], old pages, new pages,
+    min similarity, shingle size); pages that are None are read from the
+    worker's pairtree directories."""
+    htid, excerpts, old_pages, new_pages, min_similarity, shingle_size = task
+    if old_pages is None and "old" in _pairtrees:
+        old_pages = read_pairtree_volume(_pairtrees["old"], htid)
+    if new_pages is None and "new" in _pairtrees:
+        new_pages = read_pairtree_volume(_pairtrees["new"], htid)
+
+    results = []
+    if not old_pages or not new_pages:
+        note = "old version not found" if not old_pages else "new version not found"
+        for index, pages_digital in excerpts:
+            results.append({"index": index, "proposed_range": None, "confidence": 0.0, "aligned_pages": 0, "note": note})
+        return results
+
+    new_shingles = {order: shingle_set(text, shingle_size) for order, text in new_pages.items()}
+    shingle_index = {}
+    for order, shingles in new_shingles.items():
+        for shingle in shingles:
+            shingle_index.setdefault(shingle, []).append(order)
+
+    for index, pages_digital in excerpts:
+        spans = []
+        confidence = 0.0
+        aligned = 0
+        page_count = 0
+        for start, end in intspan(pages_digital).ranges():
+            span, span_confidence, span_aligned = remap_span(
+                start, end, old_pages, new_shingles, shingle_index, min_similarity, shingle_size
+            )
+            spans.append(span)
+            # weight each span's confidence by its number of pages
+            confidence += span_confidence * (end - start + 1)
+            page_count += end - start + 1
+            aligned += span_aligned
+        proposed = None
+        if all(spans):
+            proposed = str(intspan.from_ranges(spans))
+        results.append(
+            {
+                "index": index,
+                "proposed_range": proposed,
+                "confidence": round(confidence / page_count, 3) if proposed else 0.0,
+                "aligned_pages": aligned,
+                "note": None if proposed else "pages not matched",
+            }
+        )
+    return results
+
+
+def init_worker(pairtrees: dict[str, pathlib.Path]):
+    global _pairtrees
+    _pairtrees = pairtrees
+
+
+def remap_excerpts(
+    excerpts_df: pl.DataFrame,
+    old_source: pathlib.Path,
+    new_source: pathlib.Path,
+    min_similarity: float = DEFAULT_MIN_SIMILARITY,
+    shingle_size: int = DEFAULT_SHINGLE_SIZE,
+    workers: int = DEFAULT_WORKERS,
+) -> pl.DataFrame:
+    """Propose new digital ranges for excerpts with `source_id` (htid) and
+    `pages_digital` columns. Old and new sources are corpus exports or
+    pairtree directories. Returns the excerpts with `proposed_range`,
+    `confidence`, `aligned_pages`, and `note` columns."""
+    excerpts_df = excerpts_df.with_row_index("index")
+    volumes = {}
+    for index, htid, pages_digital in excerpts_df.select("index", "source_id", "pages_digital").iter_rows():
+        volumes.setdefault(htid, []).append((index, pages_digital))
+
+    # corpus exports are read here, once; pairtree volumes are read by the workers
+    pages = {}
+    pairtrees = {}
+    for name, source in [("old", old_source), ("new", new_source)]:
+        if source.is_dir():
+            pairtrees[name] = source
+        else:
+            print(f"Reading {name} pages from {source}")
+            pages[name] = read_volumes(source, set(volumes))
+    tasks = [
+        (
+            htid,
+            excerpts,
+            pages["old"].get(htid) if "old" in pages else None,
+            pages["new"].get(htid) if "new" in pages else None,
+            min_similarity,
+            shingle_size,
+        )
+        for htid, excerpts in volumes.items()
+    ]
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        # polars is multithreaded and not safe to fork
+        mp_context=get_context("spawn"),
+        initializer=init_worker,
+        initargs=(pairtrees,),
+    ) as executor:
+        results = [result for volume_results in executor.map(remap_volume, tasks) for result in volume_results]
+
+    results_df = pl.DataFrame(
+        results,
+        schema={
+            "index": pl.UInt32,
+            "proposed_range": pl.String,
+            "confidence": pl.Float64,
+            "aligned_pages": pl.Int64,
+            "note": pl.String,
+        },
+    )
+    return excerpts_df.join(results_df, on="index").sort("index").drop("index")
+
+
+def validate(results_df: pl.DataFrame) -> pl.DataFrame:
+    """Compare proposed ranges with the manually corrected `new digital range`,
+    where `correct` means the range is unchanged; suppressed excerpts are
+    left out. Returns the number of excerpts and proposals that match, overall
+    and for proposals at each confidence level."""
+    checked_df = (
+        results_df.filter(pl.col("new digital range").ne("SUPPRESS"))
+        .with_columns(
+            expected=pl.when(pl.col("new digital range").eq("correct"))
+            .then(pl.col("pages_digital"))
+            .otherwise(pl.col("new digital range"))
+            .map_elements(lambda pages: str(intspan(pages)), return_dtype=pl.String)
+        )
+        .with_columns(match=pl.col("proposed_range").eq_missing(pl.col("expected")))
+    )
+    levels = [0.0, *CONFIDENCE_LEVELS]
+    return pl.concat(
+        [
+            checked_df.filter(pl.col("confidence") >= level).select(
+                min_confidence=pl.lit(level),
+                excerpts=pl.len(),
+                correct=pl.col("match").sum(),
+                accuracy=pl.col("match").mean(),
+            )
+            for level in levels
+        ]
+    ).with_columns(coverage=pl.col("excerpts") / checked_df.height)
+
+
+def main(
+    old_source: pathlib.Path,
+    new_source: pathlib.Path,
+    excerpts_file: pathlib.Path = EXCERPTS_FILE,
+    output: pathlib.Path | None = None,
+    min_similarity: float = DEFAULT_MIN_SIMILARITY,
+    workers: int = DEFAULT_WORKERS,
+):
+    excerpts_df = pl.read_csv(excerpts_file, infer_schema=False)
+    results_df = remap_excerpts(excerpts_df, old_source, new_source, min_similarity, workers=workers)
+    if output:
+        results_df.write_csv(output)
+        print(f"Saved proposed ranges for {results_df.height:,} excerpts to {output}")
+    print(
+        results_df.select(
+            excerpts=pl.len(),
+            proposed=pl.col("proposed_range").is_not_null().sum(),
+            changed=(pl.col("proposed_range") != pl.col("pages_digital")).sum(),
+            mean_confidence=pl.col("confidence").mean(),
+        )
+    )
+    if "new digital range" in results_df.columns:
+        print(validate(results_df))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Propose new digital page ranges for PPA excerpts")
+    parser.add_argument(
+        "old", type=pathlib.Path, help="Old version of the volumes: corpus export or HathiTrust pairtree directory"
+    )
+    parser.add_argument(
+        "new", type=pathlib.Path, help="New version of the volumes: corpus export or HathiTrust pairtree directory"
+    )
+    parser.add_argument(
+        "--excerpts", type=pathlib.Path, default=EXCERPTS_FILE,
+        help="CSV of excerpts with source_id and pages_digital columns (default: %(default)s)",
+    )
+    parser.add_argument("-o", "--output", type=pathlib.Path, help="Save proposed ranges to a CSV file")
+    parser.add_argument(
+        "--min-similarity", type=float, default=DEFAULT_MIN_SIMILARITY,
+        help="Minimum similarity for pages to match (default: %(default)s)",
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=DEFAULT_WORKERS,
+        help="Number of volumes to process at once (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    main(args.old, args.new, args.excerpts, args.output, args.min_similarity, args.workers)
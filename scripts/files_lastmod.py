@@ -1,30 +1,192 @@
 #!/usr/bin/env python3
 #
+# With --previous, only lists directories whose modification time changed since
+# the previous crawl. A directory's mtime changes when files or subdirectories in
+# it are added, removed, or replaced (rsync writes a temporary file and renames it),
+# but not when a file is modified in place. For an unchanged directory, the previous
+# records for its files are copied and the crawl continues into the subdirectories
+# it had before, so only a stat is needed for each directory that didn't change.
+# Each crawl saves directory mtimes alongside the output ([output]_dirs.csv)
+# for the next run; an incremental crawl also saves the files added, removed,
+# and modified since the previous crawl ([output]_changes.csv).
 import argparse
 import csv
 import datetime
-import pathlib
+import itertools
 import os
+import pathlib
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+#: number of directory listings run at once; on a network filesystem each is a slow round trip
+DEFAULT_WORKERS = 16
+#: number of rows written to the CSV at once
+BATCH_SIZE = 10_000
+
+
+def scan_dir(path, basedir, extensions, previous_dirs, previous_children, start_time):
+    # file type comes with the directory listing (DirEntry), so the only
+    # other call per file is the stat for modification time on matching files.
+    # Most pairtree directories have a single subdirectory, so the scan continues
+    # into one subdirectory and returns the rest to be queued.
+    # Returns queued subdirectories, (directory, rows, mtime) for each directory
+    # listed, directories that haven't changed since the previous crawl, and
+    # directories that couldn't be listed
+    queued = []
+    listed = []
+    unchanged = []
+    failed = []
+    while path is not None:
+        subdirs = []
+        rows = []
+        directory = path[len(basedir):]
+        try:
+            if previous_dirs.get(directory) is not None and os.stat(path).st_mtime == previous_dirs[directory]:
+                unchanged.append(directory)
+                subdirs = [basedir + child for child in previous_children.get(directory, [])]
+            else:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                        elif entry.is_file() and os.path.splitext(entry.name)[1].lstrip('.') in extensions:
+                            try:
+                                mod_time = entry.stat().st_mtime
+                            except FileNotFoundError:
+                                # removed since the directory was listed
+                                continue
+                            # include the full filename, because we need the prefix to convert filename to HTID
+                            rows.append((entry.path[len(basedir):], mod_time, datetime.datetime.fromtimestamp(mod_time)))
+                # a directory changed since the crawl started may have changed while it was
+                # listed, so its mtime isn't kept and it is listed again next time
+                mtime = os.stat(path).st_mtime
+                listed.append((directory, rows, mtime if mtime < start_time else None))
+        except FileNotFoundError:
+            # removed since its parent was listed
+            listed.append((directory, [], None))
+            subdirs = []
+        except OSError as err:
+            print(f'Skipping {path} and everything under it: {err}', file=sys.stderr)
+            failed.append(directory)
+            subdirs = []
+        path = subdirs.pop() if subdirs else None
+        queued.extend(subdirs)
+    return queued, listed, unchanged, failed
+
+
+def crawl(basedir, extensions, workers=DEFAULT_WORKERS, previous_dirs=None):
+    # list directories on a thread pool, queueing subdirectories as each listing finishes;
+    # uses os.scandir rather than pathlib.Path.walk so this can run under python 3.11
+    basedir = os.path.join(str(basedir), '')
+    previous_dirs = previous_dirs or {}
+    # subdirectories of each directory in the previous crawl
+    previous_children = {}
+    for directory in previous_dirs:
+        if directory:
+            previous_children.setdefault(os.path.dirname(directory), []).append(directory)
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        args = (basedir, extensions, previous_dirs, previous_children, start_time)
+        pending = {executor.submit(scan_dir, basedir, *args)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                subdirs, listed, unchanged, failed = future.result()
+                pending.update(executor.submit(scan_dir, subdir, *args) for subdir in subdirs)
+                yield listed, unchanged, failed
+
+
+def dirs_file(output):
+    return output.with_name(f'{output.stem}_dirs.csv')
+
 
-def main(basedir, ext, output):
+def changes_file(output):
+    return output.with_name(f'{output.stem}_changes.csv')
+
+
+def read_previous(previous):
+    # previous file records by directory, and directory mtimes (None if not kept)
+    previous_files = {}
+    with previous.open(newline='') as csvfile:
+        reader = csv.reader(csvfile)
+        next(reader)
+        for row in reader:
+            previous_files.setdefault(os.path.dirname(row[0]), []).append(row)
+    previous_dirs = {}
+    if dirs_file(previous).exists():
+        with dirs_file(previous).open(newline='') as csvfile:
+            previous_dirs = {
+                directory: float(mtime) if mtime else None
+                for directory, mtime in itertools.islice(csv.reader(csvfile), 1, None)
+            }
+    return previous_files, previous_dirs
+
+
+def in_directories(directory, parents):
+    # whether a directory is one of the given directories or under one of them
+    return any(directory == parent or directory.startswith(os.path.join(parent, '')) for parent in parents)
+
+
+def compare_files(rows, previous_rows):
+    # changes between the current and previous records for the files in one directory
+    previous_by_name = {row[0]: row for row in previous_rows}
+    for filename, mod_time, last_modified in rows:
+        previous_row = previous_by_name.pop(filename, None)
+        if previous_row is None:
+            yield (filename, 'added', mod_time, last_modified)
+        elif float(previous_row[1]) != mod_time:
+            yield (filename, 'modified', mod_time, last_modified)
+    for filename, mod_time, last_modified in previous_by_name.values():
+        yield (filename, 'removed', mod_time, last_modified)
+
+
+def main(basedir, ext, output, workers=DEFAULT_WORKERS, previous=None):
     extensions = ext.split(',')
-    with output.open('w') as csvfile:
-        fieldnames = ['filename', 'mtime', 'last_modified']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        # use os.walk so this can run under python 3.11
-        for (dir, _dirnames, filenames) in os.walk(basedir):
-            dir_path = pathlib.Path(dir)
-            for file in filenames:
-                file_path = dir_path / file
-                if file_path.is_file() and file_path.suffix.lstrip('.') in extensions:
-                    mod_time = file_path.stat().st_mtime
-                    # include the full filename, because we need the prefix to convert filename to HTID
-                    writer.writerow({
-                        'filename': str(file_path.relative_to(basedir)),
-                        'mtime': mod_time,
-                        'last_modified': datetime.datetime.fromtimestamp(mod_time)
-                    })
+    previous_files, previous_dirs = read_previous(previous) if previous else ({}, {})
+    with output.open('w', newline='') as csvfile, dirs_file(output).open('w', newline='') as dirsfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['filename', 'mtime', 'last_modified'])
+        dirs_writer = csv.writer(dirsfile)
+        dirs_writer.writerow(['directory', 'mtime'])
+        changes = []
+        batch = []
+        all_failed = []
+        for listed, unchanged, failed in crawl(basedir, extensions, workers, previous_dirs):
+            # every directory is saved, so the subdirectories of unchanged directories are
+            # known next time; those without an mtime are always listed
+            for directory, rows, mtime in listed:
+                batch.extend(rows)
+                dirs_writer.writerow((directory, mtime))
+                if previous:
+                    changes.extend(compare_files(rows, previous_files.pop(directory, [])))
+            for directory in unchanged:
+                # copy the previous records as they are
+                batch.extend(previous_files.pop(directory, []))
+                dirs_writer.writerow((directory, previous_dirs[directory]))
+            dirs_writer.writerows((directory, None) for directory in failed)
+            all_failed.extend(failed)
+            if len(batch) >= BATCH_SIZE:
+                writer.writerows(batch)
+                batch = []
+        # directories that couldn't be listed keep the previous records for the files under
+        # them, and have no mtime saved, so they are listed again next time
+        for directory in list(previous_files):
+            if all_failed and in_directories(directory, all_failed):
+                batch.extend(previous_files.pop(directory))
+        writer.writerows(batch)
+
+    if all_failed:
+        print(f'{len(all_failed):,} directories could not be listed', file=sys.stderr)
+    if previous:
+        # files in directories that weren't found this time were removed
+        for previous_rows in previous_files.values():
+            changes.extend(compare_files([], previous_rows))
+        with changes_file(output).open('w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['filename', 'change', 'mtime', 'last_modified'])
+            writer.writerows(sorted(changes, key=lambda row: row[0]))
+        print(f'{len(changes):,} files added, removed, or modified since {previous}; saved to {changes_file(output)}')
 
 
 if __name__ == "__main__":
@@ -33,6 +195,14 @@ if __name__ == "__main__":
     parser.add_argument('dir', help='Directory to search', type=pathlib.Path)
     parser.add_argument('ext', help='File extensions to match')
     parser.add_argument("-o", "--output", help="Output file", type=pathlib.Path)
+    parser.add_argument(
+        "-w", "--workers", type=int, default=DEFAULT_WORKERS,
+        help="Number of directories to list at once (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--previous", type=pathlib.Path,
+        help="Output of a previous crawl; only rescan directories changed since then, and save the changes",
+    )
     args = parser.parse_args()
 
-    main(args.dir, args.ext, args.output)
+    main(args.dir, args.ext, args.output, args.workers, args.previous)
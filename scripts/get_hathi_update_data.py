@@ -1,56 +1,487 @@
 #!/usr/bin/env python3
 """
 Download a local copy of HathiTrust update data for analysis.
+
+Files are downloaded several at a time over a shared HTTP session. Incomplete
+downloads are kept as `.part` files and resumed with HTTP range requests;
+very large files (i.e., the monthly full hathifiles) are split into byte
+ranges that are downloaded in parallel and joined when all are complete.
+
+A manifest of synced files (size, modified and created dates from the
+hathifiles file list, plus a local checksum) is kept in the data directory,
+so each run only downloads new or changed files. When the file list itself
+has not changed since the last complete sync, nothing else is checked.
+
+With `--parquet`, each file is also converted to a typed, zstd-compressed
+Parquet copy sorted by htid (see `hathifiles.py`) as soon as its download
+completes.
+
+With `--cache`, files are stored in the shared local data cache (see
+`data_cache.py`) and linked into the data directory, so other checkouts on
+the same machine can link them instead of downloading them again.
+
+To test against a local server, serve a directory with a fake file list
+and pass its url with `--file-list-url` and a scratch `--data-dir`.
 """
 
+import argparse
+import datetime
 import json
 import pathlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+import polars as pl
 import requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 
+from data_cache import DataCache, file_checksum, parse_size
+from gzip_index import index_path
+from hathifiles import load_field_list, parquet_path, transcode, update_file_date
+
 DATA_DIR = pathlib.Path(__file__).parent.parent.resolve() / "data" / "hathi" / "updates"
 
 FILE_LIST_URL = "https://www.hathitrust.org/files/hathifiles/hathi_file_list.json"
 
+#: number of files to download at once
+DEFAULT_WORKERS = 4
+#: files larger than this are split into byte ranges downloaded in parallel
+SPLIT_SIZE = 256 * 1024 * 1024
+#: number of byte ranges to split large files into
+DEFAULT_SEGMENTS = 4
+#: number of times to resume a download after a dropped connection
+RETRIES = 5
+
+#: local record of synced files, so unchanged files can be skipped without checking them
+MANIFEST_FILENAME = "hathi_manifest.json"
+#: fields from the hathifiles file list used to detect changed files
+MANIFEST_FIELDS = ["size", "modified", "created"]
+
+CHUNK_SIZE = 1024 * 1024
+TIMEOUT = 60  # seconds to wait for a connection or for the next chunk of data
+
+
+def get_session(pool_size: int = DEFAULT_WORKERS) -> requests.Session:
+    """Create a requests session with a connection pool large enough
+    for `pool_size` simultaneous requests."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def part_path(filename: pathlib.Path, segment: int = 0) -> pathlib.Path:
+    """Path for a partial download. The first segment uses the plain `.part`
+    file, so a partial single-stream download can be resumed as a split
+    download and vice versa."""
+    suffix = ".part" if segment == 0 else f".part{segment}"
+    return filename.with_name(f"{filename.name}{suffix}")
+
+
+def accepts_ranges(session: requests.Session, url: str) -> bool:
+    """Check whether the server advertises support for byte range requests."""
+    response = session.head(url, allow_redirects=True, timeout=TIMEOUT)
+    return response.ok and response.headers.get("Accept-Ranges") == "bytes"
 
-def download_file(url:str, filename: pathlib.Path, expected_size: int | None = None) -> pathlib.Path:
+
+def fetch_range(
+    session: requests.Session,
+    url: str,
+    part_file: pathlib.Path,
+    start: int = 0,
+    end: int | None = None,
+    progress: tqdm | None = None,
+) -> pathlib.Path:
+    """Download bytes `start` through `end` (inclusive; `None` for the end
+    of the file) of `url` into `part_file`. Any content already in `part_file`
+    is kept and the download resumes after it, including after a dropped
+    connection."""
+    expected_size = None if end is None else end - start + 1
+    offset = part_file.stat().st_size if part_file.exists() else 0
+    if expected_size is not None and offset > expected_size:
+        # content is a prefix of this range, so anything past the end can be dropped
+        with part_file.open("r+b") as filehandle:
+            filehandle.truncate(expected_size)
+        offset = expected_size
+    if progress is not None:
+        progress.update(offset)
+
+    for attempt in range(RETRIES + 1):
+        if expected_size is not None and offset >= expected_size:
+            break
+        headers = {}
+        if start + offset > 0 or end is not None:
+            headers["Range"] = f"bytes={start + offset}-{'' if end is None else end}"
+        try:
+            with session.get(url, stream=True, headers=headers, timeout=TIMEOUT) as response:
+                if response.status_code == 416 and end is None and offset > 0:
+                    # size not known, and the partial file already has everything
+                    break
+                response.raise_for_status()
+                mode = "ab"
+                if headers and response.status_code != 206:
+                    # server ignored the range; only usable if the range is the whole file
+                    whole_file = end is None or response.headers.get("Content-Length") == str(expected_size)
+                    if start != 0 or not whole_file:
+                        raise RuntimeError(f"Server does not support range requests for {url}")
+                    mode = "wb"
+                    if progress is not None:
+                        progress.update(-offset)
+                    offset = 0
+
+                with part_file.open(mode) as filehandle:
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        filehandle.write(chunk)
+                        offset += len(chunk)
+                        if progress is not None:
+                            progress.update(len(chunk))
+            break
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as err:
+            if attempt == RETRIES:
+                raise
+            print(f"Connection error downloading {part_file.name} ({err}); resuming")
+
+    return part_file
+
+
+def download_file(
+    url: str,
+    filename: pathlib.Path,
+    expected_size: int | None = None,
+    session: requests.Session | None = None,
+    split_size: int = SPLIT_SIZE,
+    segments: int = DEFAULT_SEGMENTS,
+) -> pathlib.Path:
     if filename.exists():
         # check size if known
         if expected_size is None or filename.stat().st_size == expected_size:
             print(f"File {filename.name} already exists; skipping download")
             return filename
+        elif filename.stat().st_size < expected_size:
+            # probably an interrupted download from before partial files were used
+            print(f"File {filename.name} is smaller than expected; resuming download")
+            filename.replace(part_path(filename))
         else:
             print(f"File {filename.name} exists but does not have expected size; redownloading")
             filename.unlink()
 
-    with requests.get(url, stream=True) as response:
-        response.raise_for_status()
-
-        # wrap content iterator with tqdm to report status for large files
-        # adapted from https://stackoverflow.com/a/75335430
-        progress_chunks = tqdm(
-            response.iter_content(chunk_size=8192),
-            total=expected_size,  # in bytes
-            desc=f"Downloading {filename.name}",
-            unit="B",
-            unit_scale=True,
-            unit_divisor=1024,  # make use of standard units e.g. KB, MB, etc.
-            miniters=1,  # recommended for network progress that might vary strongly
+    session = session or get_session()
+    part_file = part_path(filename)
+
+    progress = tqdm(
+        total=expected_size,  # in bytes
+        desc=f"Downloading {filename.name}",
+        unit="B",
+        unit_scale=True,
+        unit_divisor=1024,  # make use of standard units e.g. KB, MB, etc.
+        miniters=1,  # recommended for network progress that might vary strongly
+    )
+    with progress:
+        if (
+            expected_size is not None
+            and expected_size > split_size
+            and segments > 1
+            and accepts_ranges(session, url)
+        ):
+            download_segments(session, url, filename, expected_size, segments, progress)
+        else:
+            # with the size known, a complete partial file is not requested again
+            end = None if expected_size is None else expected_size - 1
+            fetch_range(session, url, part_file, end=end, progress=progress)
+
+    if expected_size is not None and part_file.stat().st_size != expected_size:
+        raise RuntimeError(
+            f"Downloaded {part_file.stat().st_size:,} bytes for {filename.name}; expected {expected_size:,}"
         )
-        with filename.open('wb') as filehandle:
-            for chunk in progress_chunks:
-                filehandle.write(chunk)
+    part_file.replace(filename)
+    return filename
+
+
+def download_segments(
+    session: requests.Session,
+    url: str,
+    filename: pathlib.Path,
+    size: int,
+    segments: int,
+    progress: tqdm | None = None,
+):
+    """Download a file as `segments` byte ranges in parallel, then join
+    them into the first segment's partial file."""
+    segment_size = -(-size // segments)  # ceiling division
+    ranges = [
+        (i, start, min(start + segment_size, size) - 1)
+        for i, start in enumerate(range(0, size, segment_size))
+    ]
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        futures = [
+            executor.submit(fetch_range, session, url, part_path(filename, i), start, end, progress)
+            for i, start, end in ranges
+        ]
+        # raise any errors from the segment downloads
+        for future in futures:
+            future.result()
+
+    # append all other segments to the first one
+    with part_path(filename).open("ab") as filehandle:
+        for i, _start, _end in ranges[1:]:
+            segment_file = part_path(filename, i)
+            with segment_file.open("rb") as segment:
+                while chunk := segment.read(CHUNK_SIZE):
+                    filehandle.write(chunk)
+            segment_file.unlink()
 
+
+def download_and_transcode(
+    url: str, filename: pathlib.Path, expected_size: int | None, field_list: list[str], **kwargs
+) -> pathlib.Path:
+    """Download a hathifile and convert it to Parquet as soon as it is
+    complete, while other downloads continue."""
+    download_file(url, filename, expected_size, **kwargs)
+    transcode(filename, field_list)
     return filename
 
-def main():
-    print(f"Downloading HathiTrust update data. All files will be saved in {DATA_DIR}")
 
-    file_list_filename = download_file(FILE_LIST_URL, DATA_DIR / "hathi_file_list.json")
-    file_list = json.load(file_list_filename.open())
+def load_manifest(data_dir: pathlib.Path) -> dict:
+    manifest_file = data_dir / MANIFEST_FILENAME
+    if manifest_file.exists():
+        with manifest_file.open() as filehandle:
+            return json.load(filehandle)
+    return {"file_list": {}, "files": {}}
+
+
+def save_manifest(data_dir: pathlib.Path, manifest: dict):
+    # write to a temporary file and rename, so an interrupted run can't corrupt it
+    tmp_file = data_dir / f"{MANIFEST_FILENAME}.tmp"
+    with tmp_file.open("w") as filehandle:
+        json.dump(manifest, filehandle, indent=2, sort_keys=True)
+    tmp_file.replace(data_dir / MANIFEST_FILENAME)
+
+
+def fetch_file_list(
+    session: requests.Session, url: str, data_dir: pathlib.Path, manifest: dict
+) -> list[dict] | None:
+    """Download the hathifiles file list if it has changed since the last run,
+    using a conditional request. Returns `None` when the file list is
+    unchanged and the last sync completed."""
+    file_list_filename = data_dir / "hathi_file_list.json"
+    cached = manifest["file_list"]
+    headers = {}
+    if file_list_filename.exists():
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+    response = session.get(url, headers=headers, timeout=TIMEOUT)
+    response.raise_for_status()
+    if response.status_code == 304:
+        if cached.get("complete"):
+            return None
+        # previous sync did not finish; pick up where it left off
+        with file_list_filename.open() as filehandle:
+            return json.load(filehandle)
+
+    file_list_filename.write_bytes(response.content)
+    manifest["file_list"] = {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "complete": False,
+    }
+    return response.json()
+
+
+def prune_updates(data_dir: pathlib.Path, manifest: dict, cutoff: datetime.date):
+    """Remove daily update files dated before `cutoff`, along with their
+    Parquet copies and gzip indexes."""
+    names = set(manifest["files"]) | {path.name for path in data_dir.glob("hathi_upd_*.txt.gz")}
+    for name in sorted(names):
+        file_date = update_file_date(name)
+        if file_date is not None and file_date < cutoff:
+            print(f"Removing {name} (older than {cutoff})")
+            update_file = data_dir / name
+            for path in (update_file, parquet_path(update_file), index_path(update_file)):
+                path.unlink(missing_ok=True)
+            manifest["files"].pop(name, None)
+
+
+def cache_name(filename: pathlib.Path) -> str:
+    """Name for a hathifile in the shared data cache."""
+    return f"hathi/updates/{filename.name}"
+
+
+def cache_version(file: dict) -> str:
+    """Upstream version of a hathifile in the file list, used to check
+    whether a cached copy is current."""
+    return f"{file['size']}|{file['modified']}"
+
+
+def main(
+    data_dir: pathlib.Path = DATA_DIR,
+    file_list_url: str = FILE_LIST_URL,
+    workers: int = DEFAULT_WORKERS,
+    split_size: int = SPLIT_SIZE,
+    segments: int = DEFAULT_SEGMENTS,
+    retention_days: int | None = None,
+    verify: bool = False,
+    parquet: bool = False,
+    cache: DataCache | None = None,
+):
+    print(f"Downloading HathiTrust update data. All files will be saved in {data_dir}")
+    data_dir.mkdir(parents=True, exist_ok=True)
+
+    # one connection per file, or per segment for split files
+    session = get_session(workers * max(segments, 1))
+    manifest = load_manifest(data_dir)
+    if verify:
+        # check local files against the manifest; anything missing or modified is synced again
+        for name, entry in list(manifest["files"].items()):
+            local_file = data_dir / name
+            if not local_file.exists() or file_checksum(local_file) != entry["sha256"]:
+                print(f"File {name} is missing or does not match the manifest")
+                del manifest["files"][name]
+                manifest["file_list"]["complete"] = False
+
+    if parquet and not all(entry.get("parquet") for entry in manifest["files"].values()):
+        # files synced before Parquet conversion was requested still need converting
+        manifest["file_list"]["complete"] = False
+
+    file_list = fetch_file_list(session, file_list_url, data_dir, manifest)
+    if file_list is None:
+        print("File list has not changed since the last sync; nothing to download")
+        return
+
+    cutoff = None
+    if retention_days is not None:
+        cutoff = datetime.date.today() - datetime.timedelta(days=retention_days)
+        prune_updates(data_dir, manifest, cutoff)
+
+    # only download files that are new or changed since the last sync
+    to_download = []
     for file in file_list:
-        download_file(file["url"], DATA_DIR / file["filename"], file['size'])
+        file_date = update_file_date(file["filename"])
+        if cutoff is not None and file_date is not None and file_date < cutoff:
+            continue
+        entry = manifest["files"].get(file["filename"])
+        if entry is not None and all(entry[field] == file[field] for field in MANIFEST_FIELDS):
+            if parquet and not entry.get("parquet"):
+                # unchanged, so the local copy is skipped by download_file and only converted
+                to_download.append(file)
+            continue
+        if entry is not None:
+            # changed upstream; don't keep or resume the old version
+            for path in [data_dir / file["filename"], part_path(data_dir / file["filename"])]:
+                path.unlink(missing_ok=True)
+            parquet_path(data_dir / file["filename"]).unlink(missing_ok=True)
+        to_download.append(file)
+    print(f"{len(to_download)} new or changed files of {len(file_list)} listed")
+
+    if cache is not None:
+        # link in any files another checkout has already downloaded
+        for file in list(to_download):
+            filename = data_dir / file["filename"]
+            digest = cache.checkout(cache_name(filename), filename, cache_version(file))
+            if digest is None:
+                continue
+            print(f"Linked {file['filename']} from the data cache")
+            has_parquet = parquet and cache.checkout(
+                cache_name(parquet_path(filename)), parquet_path(filename), cache_version(file)
+            )
+            manifest["files"][file["filename"]] = {
+                **{field: file[field] for field in MANIFEST_FIELDS},
+                "sha256": digest,
+                "parquet": bool(has_parquet),
+            }
+            if has_parquet or not parquet:
+                to_download.remove(file)
+        save_manifest(data_dir, manifest)
+
+    download = download_file
+    download_kwargs = {"session": session, "split_size": split_size, "segments": segments}
+    if parquet:
+        download = download_and_transcode
+        download_kwargs["field_list"] = load_field_list()
+
+    errors = []
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    download, file["url"], data_dir / file["filename"], file["size"], **download_kwargs
+                ): file
+                for file in to_download
+            }
+            for future in as_completed(futures):
+                file = futures[future]
+                try:
+                    filename = future.result()
+                except (requests.RequestException, RuntimeError, pl.exceptions.PolarsError) as err:
+                    errors.append(file["filename"])
+                    print(f"Error downloading {file['filename']}: {err}")
+                    continue
+                if cache is not None:
+                    digest = cache.add(filename, cache_name(filename), cache_version(file))
+                    if parquet:
+                        cache.add(parquet_path(filename), cache_name(parquet_path(filename)), cache_version(file))
+                else:
+                    digest = file_checksum(filename)
+                manifest["files"][file["filename"]] = {
+                    **{field: file[field] for field in MANIFEST_FIELDS},
+                    "sha256": digest,
+                    "parquet": parquet,
+                }
+                # save after every file so an interrupted sync keeps its progress
+                save_manifest(data_dir, manifest)
+    finally:
+        manifest["file_list"]["complete"] = all(
+            file["filename"] in manifest["files"] for file in to_download
+        )
+        save_manifest(data_dir, manifest)
+
+    if errors:
+        print(f"{len(errors)} files failed to download; run again to resume")
+
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Download HathiTrust update files (hathifiles)")
+    parser.add_argument(
+        "-d", "--data-dir", help=f"Directory for downloaded files (default: {DATA_DIR})",
+        type=pathlib.Path, default=DATA_DIR,
+    )
+    parser.add_argument("--file-list-url", help="URL for hathifiles file list", default=FILE_LIST_URL)
+    parser.add_argument(
+        "-w", "--workers", help=f"Number of files to download at once (default: {DEFAULT_WORKERS})",
+        type=int, default=DEFAULT_WORKERS,
+    )
+    parser.add_argument(
+        "--segments", help=f"Number of parallel byte ranges for large files (default: {DEFAULT_SEGMENTS})",
+        type=int, default=DEFAULT_SEGMENTS,
+    )
+    parser.add_argument(
+        "--split-size", help="Split files larger than this many MB into byte ranges (default: %(default)s)",
+        type=int, default=SPLIT_SIZE // (1024 * 1024),
+    )
+    parser.add_argument(
+        "--retention-days", help="Remove and skip daily update files older than this many days",
+        type=int,
+    )
+    parser.add_argument(
+        "--verify", help="Check local files against manifest checksums before syncing",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--parquet", help="Convert each file to Parquet (sorted by htid) as soon as it is downloaded",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cache", help="Share downloaded files with other checkouts through the local data cache",
+        action="store_true",
+    )
+    parser.add_argument("--cache-budget", help="Disk budget for the data cache, e.g. 50G", type=parse_size)
+    args = parser.parse_args()
+
+    main(
+        args.data_dir, args.file_list_url, args.workers, args.split_size * 1024 * 1024,
+        args.segments, args.retention_days, args.verify, args.parquet,
+        DataCache(budget=args.cache_budget) if args.cache or args.cache_budget else None,
+    )
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Access-point indexes for gzip files, so large hathifiles can be
+decompressed in parallel and read from any offset without recompressing
+the upstream files.
+
+An index (zran-style: deflate block offsets plus the 32 KB window needed
+to resume decompression at each one) is built with rapidgzip in one pass
+over the file and stored as a `.gzidx` sidecar next to it. With the index,
+the uncompressed content can be split into chunks that are decompressed
+independently; chunks are aligned to line boundaries, which are always
+record boundaries in hathifiles since fields are never quoted.
+
+Run as a script to build indexes for downloaded files ahead of time.
+"""
+
+import argparse
+import io
+import os
+import pathlib
+
+import rapidgzip
+
+INDEX_SUFFIX = ".gzidx"
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+
+def index_path(gzfile: pathlib.Path) -> pathlib.Path:
+    """Path for the index sidecar for a gzip file."""
+    return gzfile.with_name(f"{gzfile.name}{INDEX_SUFFIX}")
+
+
+def build_index(gzfile: pathlib.Path, workers: int = DEFAULT_WORKERS) -> pathlib.Path:
+    """Decompress a gzip file once to build its index, and save it as a sidecar."""
+    index_file = index_path(gzfile)
+    tmp_file = index_file.with_name(f"{index_file.name}.tmp")
+    with rapidgzip.open(str(gzfile), parallelization=workers) as gzip_file:
+        # seeking to the end decompresses everything, recording access points along the way
+        gzip_file.seek(0, io.SEEK_END)
+        gzip_file.export_index(str(tmp_file))
+    tmp_file.replace(index_file)
+    return index_file
+
+
+def has_index(gzfile: pathlib.Path) -> bool:
+    """Check for an index that is at least as new as the gzip file."""
+    index_file = index_path(gzfile)
+    return index_file.exists() and index_file.stat().st_mtime >= gzfile.stat().st_mtime
+
+
+def open_indexed(gzfile: pathlib.Path, workers: int = 1) -> rapidgzip.RapidgzipFile:
+    """Open a gzip file for random access using its index, building
+    the index first if there isn't a current one."""
+    if not has_index(gzfile):
+        build_index(gzfile)
+    gzip_file = rapidgzip.open(str(gzfile), parallelization=workers)
+    with index_path(gzfile).open("rb") as index_file:
+        gzip_file.import_index(index_file)
+    return gzip_file
+
+
+def next_line_start(gzip_file: rapidgzip.RapidgzipFile, offset: int, size: int) -> int:
+    """Find the uncompressed offset where the first line starting at or
+    after `offset` begins."""
+    if offset <= 0:
+        return 0
+    # a line starts at offset if the previous character ends a line
+    gzip_file.seek(offset - 1)
+    position = offset - 1
+    while position < size:
+        block = gzip_file.read(64 * 1024)
+        newline = block.find(b"\n")
+        if newline != -1:
+            return position + newline + 1
+        position += len(block)
+    return size
+
+
+def line_chunks(gzfile: pathlib.Path, num_chunks: int) -> list[tuple[int, int]]:
+    """Split the uncompressed content of a gzip file into (start, end)
+    byte ranges of roughly equal size that begin and end on line boundaries."""
+    with open_indexed(gzfile) as gzip_file:
+        size = gzip_file.size()
+        starts = sorted(
+            {next_line_start(gzip_file, size * i // num_chunks, size) for i in range(num_chunks)}
+        )
+    return [(start, end) for start, end in zip(starts, starts[1:] + [size]) if start < end]
+
+
+def read_chunk(gzfile: pathlib.Path, start: int, end: int) -> bytes:
+    """Decompress uncompressed bytes `start` to `end` of a gzip file,
+    starting from the nearest access point in the index."""
+    with open_indexed(gzfile) as gzip_file:
+        gzip_file.seek(start)
+        return gzip_file.read(end - start)
+
+
+def main(gzfiles: list[pathlib.Path], workers: int = DEFAULT_WORKERS, overwrite: bool = False):
+    for gzfile in gzfiles:
+        if has_index(gzfile) and not overwrite:
+            print(f"{index_path(gzfile).name} already exists; skipping")
+            continue
+        print(f"Indexing {gzfile.name}")
+        build_index(gzfile, workers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build access-point indexes for gzip files")
+    parser.add_argument("files", help="Gzip files to index", type=pathlib.Path, nargs="+")
+    parser.add_argument(
+        "-w", "--workers", help="Number of threads for decompression (default: %(default)s)",
+        type=int, default=DEFAULT_WORKERS,
+    )
+    parser.add_argument("--overwrite", help="Rebuild existing indexes", action="store_true")
+    args = parser.parse_args()
+
+    main(args.files, args.workers, args.overwrite)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+"""
+Current state of HathiTrust volume metadata, maintained by applying the
+rows in daily update files to the latest full hathifile, so that a new
+full file does not have to be downloaded and scanned to see recent changes.
+
+The store has three parts:
+
+- the base snapshot: the Parquet copy of the latest full file (see
+  `hathifiles.scan_snapshot`);
+- an update log: Parquet segments with every row from update files dated
+  after the base snapshot, with the update date as `last_seen_update`;
+- `current.parquet`: the base snapshot with the latest logged row for each
+  updated htid in place of its base row (upserted; htids first seen in an
+  update are added). Rows unchanged since the base snapshot have a null
+  `last_seen_update`.
+
+`view` returns the same table as of any date since the base snapshot, by
+applying only the logged rows up to that date. When a newer full file is
+downloaded, the store is rebased onto it and earlier log rows are dropped.
+
+Run as a script to bring the store up to date, or to look up rows for
+volumes (or all PPA volumes from HathiTrust) as of a date.
+"""
+
+import argparse
+import datetime
+import json
+import pathlib
+
+import polars as pl
+
+from hathi_update_counts import PPA_METADATA, file_fingerprint, load_ppa_htids
+from hathifiles import DATA_DIR, load_field_list, scan_snapshot, scan_update_files, update_file_date
+
+STORE_DIR = DATA_DIR.parent / "current"
+
+STATE_FILENAME = "state.json"
+CURRENT_FILENAME = "current.parquet"
+
+#: merge log segments into one when an update leaves more than this many
+MAX_SEGMENTS = 8
+
+
+def full_file_date(full_file: pathlib.Path) -> datetime.date:
+    """Date for a full hathifile, based on the filename."""
+    return datetime.datetime.strptime(full_file.name.split("_")[2][:8], "%Y%m%d").date()
+
+
+def load_state(store_dir: pathlib.Path = STORE_DIR) -> dict:
+    """Load the store state: the base full file, fingerprints of applied
+    update files, and the current list of log segments."""
+    state_file = store_dir / STATE_FILENAME
+    if state_file.exists():
+        return json.loads(state_file.read_text())
+    return {"base": None, "base_date": None, "files": {}, "segments": []}
+
+
+def save_state(state: dict, store_dir: pathlib.Path = STORE_DIR):
+    state_file = store_dir / STATE_FILENAME
+    tmp_file = state_file.with_name(f"{state_file.name}.tmp")
+    tmp_file.write_text(json.dumps(state, indent=2))
+    tmp_file.replace(state_file)
+
+
+def write_parquet(lazy_df: pl.LazyFrame, parquet_file: pathlib.Path):
+    """Sort rows by htid and stream them to a Parquet file."""
+    tmp_file = parquet_file.with_name(f"{parquet_file.name}.tmp")
+    lazy_df.sort("htid").sink_parquet(tmp_file, compression="zstd", statistics=True, engine="streaming")
+    tmp_file.replace(parquet_file)
+
+
+def write_segment(log_df: pl.LazyFrame, store_dir: pathlib.Path, state: dict) -> str:
+    """Write rows to a new log segment; returns the segment filename."""
+    number = max((int(name.split("_")[1].split(".")[0]) for name in state["segments"]), default=0) + 1
+    segment = f"log_{number:05d}.parquet"
+    write_parquet(log_df, store_dir / segment)
+    return segment
+
+
+def scan_base(store_dir: pathlib.Path = STORE_DIR, field_list: list[str] | None = None) -> pl.LazyFrame:
+    """Lazily load the base snapshot, with an empty `last_seen_update`."""
+    state = load_state(store_dir)
+    if state["base"] is None:
+        raise ValueError(f"No base snapshot in {store_dir}; run an update first")
+    return scan_snapshot(pathlib.Path(state["base"]), field_list).with_columns(
+        last_seen_update=pl.lit(None, dtype=pl.Date)
+    )
+
+
+def scan_log(store_dir: pathlib.Path = STORE_DIR) -> pl.LazyFrame | None:
+    """Lazily load all logged update rows, or `None` if there are none."""
+    segments = [store_dir / segment for segment in load_state(store_dir)["segments"]]
+    return pl.scan_parquet(segments) if segments else None
+
+
+def upsert(base_df: pl.LazyFrame, update_df: pl.LazyFrame) -> pl.LazyFrame:
+    """Replace rows in `base_df` with the latest row for the same htid in
+    `update_df`, and add rows for htids that are not in `base_df`."""
+    latest_df = update_df.sort("last_seen_update").unique(subset="htid", keep="last")
+    return pl.concat(
+        [base_df.join(latest_df.select("htid"), on="htid", how="anti"), latest_df],
+        how="vertical",
+    )
+
+
+def view(
+    as_of: datetime.date | None = None,
+    store_dir: pathlib.Path = STORE_DIR,
+    field_list: list[str] | None = None,
+) -> pl.LazyFrame:
+    """Lazily load volume metadata as of a date (or the current state, if
+    `as_of` is not specified). Dates before the base snapshot are not
+    available."""
+    state = load_state(store_dir)
+    current_file = store_dir / CURRENT_FILENAME
+    if as_of is None and current_file.exists():
+        return pl.scan_parquet(current_file)
+    base_date = datetime.date.fromisoformat(state["base_date"]) if state["base"] else None
+    if as_of is not None and base_date is not None and as_of < base_date:
+        raise ValueError(f"No data before {base_date}, the date of the base snapshot")
+    base_df = scan_base(store_dir, field_list)
+    log_df = scan_log(store_dir)
+    if log_df is None:
+        return base_df
+    if as_of is not None:
+        log_df = log_df.filter(pl.col("last_seen_update") <= as_of)
+    return upsert(base_df, log_df)
+
+
+def compact_log(store_dir: pathlib.Path, keep: pl.Expr) -> None:
+    """Merge log segments into one, keeping only rows that match `keep`."""
+    state = load_state(store_dir)
+    log_df = scan_log(store_dir)
+    if log_df is None:
+        return
+    old_segments = state["segments"]
+    state["segments"] = [write_segment(log_df.filter(keep), store_dir, state)]
+    # record the new segment before removing the old ones, so the state never refers to missing files
+    save_state(state, store_dir)
+    for old_segment in old_segments:
+        (store_dir / old_segment).unlink(missing_ok=True)
+
+
+def update_store(
+    full_file: pathlib.Path,
+    update_files: list[pathlib.Path],
+    store_dir: pathlib.Path = STORE_DIR,
+    field_list: list[str] | None = None,
+) -> list[pathlib.Path]:
+    """Bring the store up to date with the latest full file and the update
+    files dated after it. Returns the update files that were applied."""
+    field_list = field_list or load_field_list()
+    store_dir.mkdir(parents=True, exist_ok=True)
+    state = load_state(store_dir)
+    base_date = full_file_date(full_file)
+    rebuild = False
+
+    if state["base"] != str(full_file):
+        # rebase onto the new full file, which already includes all earlier updates
+        state |= {"base": str(full_file), "base_date": base_date.isoformat()}
+        state["files"] = {
+            name: fingerprint for name, fingerprint in state["files"].items() if update_file_date(name) > base_date
+        }
+        save_state(state, store_dir)
+        compact_log(store_dir, pl.col("last_seen_update") > base_date)
+        state = load_state(store_dir)
+        rebuild = True
+
+    pending = [
+        update_file
+        for update_file in update_files
+        if update_file_date(update_file.name) > base_date
+        and state["files"].get(update_file.name) != file_fingerprint(update_file)
+    ]
+    # update files that were applied before and have changed upstream replace their earlier rows
+    changed_dates = sorted(
+        update_file_date(update_file.name) for update_file in pending if update_file.name in state["files"]
+    )
+    if changed_dates:
+        compact_log(store_dir, ~pl.col("last_seen_update").is_in(changed_dates))
+        state = load_state(store_dir)
+        rebuild = True
+    # an update file that arrives after later ones were applied (e.g. a missed day)
+    # must not replace newer rows in the current state, so rebuild it from the log
+    applied_dates = [update_file_date(name) for name in state["files"]]
+    if pending and applied_dates and min(update_file_date(p.name) for p in pending) <= max(applied_dates):
+        rebuild = True
+
+    current_file = store_dir / CURRENT_FILENAME
+    if pending:
+        new_rows = scan_update_files(pending, field_list).rename({"date": "last_seen_update"})
+        state["segments"].append(write_segment(new_rows, store_dir, state))
+        state["files"].update({update_file.name: file_fingerprint(update_file) for update_file in pending})
+        save_state(state, store_dir)
+        if not rebuild and current_file.exists():
+            # only new rows need to be applied to the current state
+            tmp_current = current_file.with_name(f"{current_file.name}.prev")
+            current_file.replace(tmp_current)
+            write_parquet(upsert(pl.scan_parquet(tmp_current), new_rows), current_file)
+            tmp_current.unlink()
+    if len(state["segments"]) > MAX_SEGMENTS:
+        compact_log(store_dir, pl.lit(True))
+    if rebuild or not current_file.exists():
+        current_file.unlink(missing_ok=True)
+        write_parquet(view(None, store_dir, field_list), current_file)
+    return pending
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain and query the current state of HathiTrust volume metadata")
+    parser.add_argument(
+        "--store-dir", type=pathlib.Path, default=STORE_DIR, help="Store directory (default: %(default)s)"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    update_parser = subparsers.add_parser("update", help="Apply new update files, or rebase onto a new full file")
+    update_parser.add_argument(
+        "-d", "--data-dir", type=pathlib.Path, default=DATA_DIR,
+        help="Directory with downloaded hathifiles (default: %(default)s)",
+    )
+    show_parser = subparsers.add_parser("show", help="Look up volumes as of a date")
+    show_parser.add_argument("htids", nargs="*", help="Volume ids to look up")
+    show_parser.add_argument(
+        "--date", type=datetime.date.fromisoformat, help="Date in YYYY-MM-DD format (default: latest)"
+    )
+    show_parser.add_argument(
+        "--ppa", action="store_true", help=f"Look up all HathiTrust volumes in {PPA_METADATA.name}"
+    )
+    show_parser.add_argument("-o", "--output", type=pathlib.Path, help="Save results to a CSV or Parquet file")
+    args = parser.parse_args()
+
+    if args.command == "update":
+        full_files = sorted(args.data_dir.glob("hathi_full_*.txt.gz"))
+        if not full_files:
+            parser.error(f"no full hathifile in {args.data_dir}")
+        applied = update_store(full_files[-1], sorted(args.data_dir.glob("hathi_upd_*.txt.gz")), args.store_dir)
+        print(f"Applied {len(applied)} update files to {full_files[-1].name}")
+    elif args.command == "show":
+        htids = list(args.htids)
+        if args.ppa:
+            htids.extend(load_ppa_htids()["ppa_source_id"].to_list())
+        if not htids and not args.output:
+            parser.error("no htids to look up")
+        volumes_df = view(args.date, args.store_dir)
+        if htids:
+            volumes_df = volumes_df.filter(pl.col("htid").is_in(htids))
+        if args.output:
+            if args.output.suffix == ".parquet":
+                volumes_df.sink_parquet(args.output)
+            else:
+                volumes_df.sink_csv(args.output)
+            print(f"Saved volume metadata to {args.output}")
+        else:
+            for row in volumes_df.collect().iter_rows(named=True):
+                print("\n".join(f"{field}: {value}" for field, value in row.items()), end="\n\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Store of htids withdrawn from the HathiTrust public domain dataset,
+built from deletion notice emails, so that checking whether a volume
+was deleted (and when) is a lookup rather than a re-parse of every notice.
+
+Notices can be ingested as text files named by date (as in
+`data/hathi/deletions`), mbox files, or Maildir directories. Each notice
+is read a line at a time, and the ids between `===BEGIN ID LIST===` and
+`===END ID LIST===` are recorded with the date of the notice. The store is
+an sqlite database with one row per htid and deletion date, indexed by
+htid; notices that have already been ingested are skipped.
+
+Run as a script to ingest notices, check ids, or list deleted PPA volumes.
+"""
+
+import argparse
+import datetime
+import email.utils
+import mailbox
+import pathlib
+import sqlite3
+from collections.abc import Iterable, Iterator
+
+import polars as pl
+
+from hathi_update_counts import PPA_METADATA
+
+DELETIONS_DIR = pathlib.Path(__file__).parent.parent.resolve() / "data" / "hathi" / "deletions"
+STORE_FILE = DELETIONS_DIR.parent / "deleted_htids.sqlite"
+
+BEGIN_ID_LIST = "===BEGIN ID LIST==="
+END_ID_LIST = "===END ID LIST==="
+
+#: number of ids inserted at once
+BATCH_SIZE = 10_000
+
+
+def id_list(lines: Iterable[str], in_list: bool = False) -> Iterator[str]:
+    """Yield the ids between the begin and end markers of a notice; use
+    `in_list` when the begin marker has already been read."""
+    for line in lines:
+        line = line.strip()
+        if line == BEGIN_ID_LIST:
+            in_list = True
+        elif line == END_ID_LIST:
+            return
+        elif in_list and line:
+            yield line
+
+
+def message_lines(message: mailbox.Message) -> Iterator[str]:
+    """Yield lines of the plain text parts of an email message."""
+    for part in message.walk():
+        if part.get_content_type() == "text/plain":
+            payload = part.get_payload(decode=True) or b""
+            yield from payload.decode(part.get_content_charset() or "utf-8", errors="replace").splitlines()
+
+
+def read_notices(source: pathlib.Path) -> Iterator[tuple[str, datetime.date, Iterator[str]]]:
+    """Yield (notice id, date, ids) for each deletion notice in a text file
+    named by date, an mbox file, or a Maildir directory. The notice id is
+    the filename for a text file and the Message-ID for an email. Ids for
+    each notice are read lazily, and must be used before the next notice."""
+    if source.is_dir():
+        messages = mailbox.Maildir(source, create=False)
+    elif source.suffix == ".txt":
+        date = datetime.date.fromisoformat(source.stem)
+        with source.open() as notice_file:
+            yield source.name, date, id_list(notice_file)
+        return
+    else:
+        messages = mailbox.mbox(source, create=False)
+
+    for message in messages:
+        lines = message_lines(message)
+        # skip any other messages in the mailbox
+        if not any(line.strip() == BEGIN_ID_LIST for line in lines):
+            continue
+        date = email.utils.parsedate_to_datetime(message["Date"]).date()
+        notice_id = message["Message-ID"] or f"{source.name}:{date}"
+        # the begin marker has already been read, so ids start on the next line
+        yield notice_id, date, id_list(lines, in_list=True)
+
+
+def batched(ids: Iterable[str], batch_size: int = BATCH_SIZE) -> Iterator[list[str]]:
+    batch = []
+    for htid in ids:
+        batch.append(htid)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class DeletionStore:
+    """sqlite store of deleted htids by date, and of ingested notices."""
+
+    def __init__(self, store_file: pathlib.Path = STORE_FILE):
+        self.db = sqlite3.connect(store_file)
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS deletions (htid TEXT, date TEXT, PRIMARY KEY (htid, date)) WITHOUT ROWID"
+            )
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS notices (notice TEXT PRIMARY KEY, date TEXT, count INTEGER)"
+            )
+
+    def ingest(self, source: pathlib.Path) -> int:
+        """Add ids from all new notices in a source. Returns the number of notices added."""
+        added = 0
+        for notice_id, date, ids in read_notices(source):
+            if self.db.execute("SELECT 1 FROM notices WHERE notice = ?", (notice_id,)).fetchone():
+                continue
+            count = 0
+            # one transaction per notice, so an interrupted ingest leaves no partial notice behind
+            with self.db:
+                for batch in batched(ids):
+                    self.db.executemany(
+                        "INSERT OR IGNORE INTO deletions VALUES (?, ?)",
+                        [(htid, date.isoformat()) for htid in batch],
+                    )
+                    count += len(batch)
+                self.db.execute("INSERT INTO notices VALUES (?, ?, ?)", (notice_id, date.isoformat(), count))
+            added += 1
+        return added
+
+    def deletion_dates(self, htid: str) -> list[datetime.date]:
+        """Dates of notices that list an htid; empty if it was never deleted."""
+        rows = self.db.execute("SELECT date FROM deletions WHERE htid = ? ORDER BY date", (htid,))
+        return [datetime.date.fromisoformat(row[0]) for row in rows]
+
+    def __contains__(self, htid: str) -> bool:
+        return self.db.execute("SELECT 1 FROM deletions WHERE htid = ? LIMIT 1", (htid,)).fetchone() is not None
+
+    def deletions(self) -> pl.DataFrame:
+        """All deleted htids, with the date each was first deleted."""
+        rows = self.db.execute("SELECT htid, MIN(date) FROM deletions GROUP BY htid").fetchall()
+        return pl.DataFrame(rows, schema={"htid": pl.String, "date": pl.String}, orient="row").with_columns(
+            pl.col("date").str.to_date()
+        )
+
+    def notice_counts(self) -> pl.DataFrame:
+        """Number of ids in each notice, by date."""
+        rows = self.db.execute("SELECT date, SUM(count) FROM notices GROUP BY date ORDER BY date").fetchall()
+        return pl.DataFrame(rows, schema={"date": pl.String, "count": pl.Int64}, orient="row").with_columns(
+            pl.col("date").str.to_date()
+        )
+
+    def join_ppa(self, ppa_metadata: pathlib.Path = PPA_METADATA) -> pl.DataFrame:
+        """PPA works whose HathiTrust volume has been deleted, with the date
+        it was first deleted."""
+        ppa_df = pl.read_csv(ppa_metadata).filter(pl.col("ppa_source").eq("HathiTrust"))
+        return ppa_df.join(self.deletions(), left_on="ppa_source_id", right_on="htid").sort("date")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest and query HathiTrust deletion notices")
+    parser.add_argument(
+        "--store", type=pathlib.Path, default=STORE_FILE, help="Deleted htid store (default: %(default)s)"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    ingest_parser = subparsers.add_parser("ingest", help="Add deletion notices to the store")
+    ingest_parser.add_argument(
+        "sources", type=pathlib.Path, nargs="*",
+        help="Text files named by date, mbox files, or Maildir directories (default: text files in data/hathi/deletions)",
+    )
+    check_parser = subparsers.add_parser("check", help="Check whether volumes have been deleted")
+    check_parser.add_argument("htids", nargs="+")
+    ppa_parser = subparsers.add_parser("ppa", help="List PPA volumes that have been deleted")
+    ppa_parser.add_argument("--ppa-metadata", type=pathlib.Path, default=PPA_METADATA)
+    ppa_parser.add_argument("-o", "--output", type=pathlib.Path, help="Save results to a CSV file")
+    args = parser.parse_args()
+
+    store = DeletionStore(args.store)
+    if args.command == "ingest":
+        sources = args.sources or sorted(DELETIONS_DIR.glob("*.txt"))
+        added = sum(store.ingest(source) for source in sources)
+        print(f"Added {added} notices; {len(store.deletions()):,} deleted htids in total")
+    elif args.command == "check":
+        for htid in args.htids:
+            dates = store.deletion_dates(htid)
+            print(f"{htid}\t{', '.join(str(date) for date in dates) or 'not deleted'}")
+    elif args.command == "ppa":
+        ppa_deleted_df = store.join_ppa(args.ppa_metadata)
+        if args.output:
+            ppa_deleted_df.write_csv(args.output)
+            print(f"Saved {ppa_deleted_df.height:,} deleted PPA volumes to {args.output}")
+        else:
+            print(ppa_deleted_df)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Field-level differences between two full hathifile snapshots: which
+htids were added or removed, and which fields changed for the htids
+in both.
+
+Both snapshots are compared through their Parquet copies (see
+`hathifiles.scan_snapshot`), which are sorted by htid with row group
+statistics. The htid space is split into consecutive ranges, and each
+range is loaded from both snapshots and compared on its own, so memory
+use is bounded by the range size rather than the size of the snapshots.
+
+Results are saved as Parquet with one row per added, removed, or
+changed htid: `htid`, `status`, and `changed_fields` (the list of
+fields with different values; empty for added and removed htids).
+
+Run as a script to compare two snapshots, or each consecutive pair of
+full files that have been downloaded.
+"""
+
+import argparse
+import pathlib
+import re
+import tempfile
+
+import polars as pl
+
+from hathifiles import DATA_DIR, load_field_list, scan_snapshot
+
+OUTPUT_DIR = DATA_DIR.parent / "diffs"
+
+FULL_FILE_DATE = re.compile(r"hathi_full_(\d{8})")
+
+STATUS = pl.Enum(["added", "removed", "changed"])
+
+#: approximate number of htids compared at once
+DEFAULT_RANGE_SIZE = 500_000
+
+
+def diff_path(old_file: pathlib.Path, new_file: pathlib.Path, output_dir: pathlib.Path = OUTPUT_DIR) -> pathlib.Path:
+    """Path for the diff between two full files, e.g.
+    `hathi_diff_20250601_20250701.parquet`."""
+    old_date = FULL_FILE_DATE.search(old_file.name).group(1)
+    new_date = FULL_FILE_DATE.search(new_file.name).group(1)
+    return output_dir / f"hathi_diff_{old_date}_{new_date}.parquet"
+
+
+def htid_ranges(snapshot_df: pl.LazyFrame, range_size: int) -> list[tuple[str | None, str | None]]:
+    """Split the htids in a snapshot into consecutive (start, end) ranges of
+    about `range_size` ids; `None` leaves the first and last range open."""
+    # every nth htid of a sorted snapshot marks a range boundary; only the htid column is read
+    boundaries = (
+        snapshot_df.select("htid").gather_every(range_size, offset=range_size).collect(engine="streaming")["htid"]
+    ).to_list()
+    starts = [None, *boundaries]
+    return list(zip(starts, [*boundaries, None]))
+
+
+def in_range(start: str | None, end: str | None) -> pl.Expr:
+    expr = pl.lit(True)
+    if start is not None:
+        expr &= pl.col("htid") >= start
+    if end is not None:
+        expr &= pl.col("htid") < end
+    return expr
+
+
+def diff_frames(old_df: pl.DataFrame, new_df: pl.DataFrame, fields: list[str]) -> pl.DataFrame:
+    """Compare two sets of hathifile rows by htid."""
+    field_enum = pl.Enum(fields)
+    joined_df = old_df.join(new_df, on="htid", how="full", coalesce=True, suffix="_new")
+    # an htid on only one side has nulls for all of the other side's columns, including the marker
+    changed_fields = pl.concat_list(
+        [
+            pl.when(pl.col(field).ne_missing(pl.col(f"{field}_new"))).then(pl.lit(field, dtype=field_enum))
+            for field in fields
+        ]
+    ).list.drop_nulls()
+    return (
+        joined_df.select(
+            "htid",
+            status=pl.when(pl.col("_present").is_null())
+            .then(pl.lit("added"))
+            .when(pl.col("_present_new").is_null())
+            .then(pl.lit("removed"))
+            .otherwise(pl.lit("changed"))
+            .cast(STATUS),
+            changed_fields=changed_fields,
+        )
+        .with_columns(
+            changed_fields=pl.when(pl.col("status") == "changed")
+            .then(pl.col("changed_fields"))
+            .otherwise(pl.lit([], dtype=pl.List(field_enum)))
+        )
+        .filter((pl.col("status") != "changed") | (pl.col("changed_fields").list.len() > 0))
+    )
+
+
+def diff_snapshots(
+    old_file: pathlib.Path,
+    new_file: pathlib.Path,
+    output: pathlib.Path,
+    field_list: list[str] | None = None,
+    range_size: int = DEFAULT_RANGE_SIZE,
+) -> pl.DataFrame:
+    """Compare two full hathifiles range by range and save the differences
+    to `output`. Returns a summary with the number of htids for each
+    status, and for each changed field."""
+    field_list = field_list or load_field_list()
+    fields = [field for field in field_list if field != "htid"]
+    old_snapshot = scan_snapshot(old_file, field_list).with_columns(_present=pl.lit(True))
+    new_snapshot = scan_snapshot(new_file, field_list).with_columns(_present=pl.lit(True))
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=output.parent) as tmp_dir:
+        part_files = []
+        for i, (start, end) in enumerate(htid_ranges(old_snapshot, range_size)):
+            # row group statistics mean only the groups overlapping the range are read
+            old_df = old_snapshot.filter(in_range(start, end)).collect()
+            new_df = new_snapshot.filter(in_range(start, end)).collect()
+            part_file = pathlib.Path(tmp_dir) / f"part_{i:05d}.parquet"
+            diff_frames(old_df, new_df, fields).write_parquet(part_file)
+            part_files.append(part_file)
+
+        tmp_file = output.with_name(f"{output.name}.tmp")
+        pl.scan_parquet(part_files).sink_parquet(tmp_file, compression="zstd", statistics=True)
+        tmp_file.replace(output)
+
+    diff_df = pl.scan_parquet(output)
+    return pl.concat(
+        [
+            diff_df.group_by(name=pl.col("status").cast(pl.String)).len(name="count"),
+            diff_df.select(name=pl.col("changed_fields").explode().cast(pl.String))
+            .drop_nulls()
+            .group_by("name")
+            .len(name="count"),
+        ]
+    ).collect().sort("count", descending=True)
+
+
+def main(
+    full_files: list[pathlib.Path],
+    output: pathlib.Path | None = None,
+    output_dir: pathlib.Path = OUTPUT_DIR,
+    range_size: int = DEFAULT_RANGE_SIZE,
+    overwrite: bool = False,
+):
+    pairs = list(zip(full_files, full_files[1:]))
+    if not pairs:
+        print("Need at least two full hathifiles to compare")
+        return
+    for old_file, new_file in pairs:
+        diff_file = output or diff_path(old_file, new_file, output_dir)
+        if diff_file.exists() and not overwrite:
+            print(f"{diff_file.name} already exists; skipping")
+            continue
+        print(f"Comparing {old_file.name} to {new_file.name}")
+        summary_df = diff_snapshots(old_file, new_file, diff_file, range_size=range_size)
+        for name, count in summary_df.iter_rows():
+            print(f"  {name}: {count:,}")
+        print(f"Saved differences to {diff_file}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare full hathifile snapshots field by field")
+    parser.add_argument(
+        "files", type=pathlib.Path, nargs="*",
+        help="Full hathifiles to compare, oldest first (default: all in data/hathi/updates)",
+    )
+    parser.add_argument("-o", "--output", type=pathlib.Path, help="Output file, when comparing two files")
+    parser.add_argument(
+        "--output-dir", type=pathlib.Path, default=OUTPUT_DIR, help="Directory for output files (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--range-size", type=int, default=DEFAULT_RANGE_SIZE,
+        help="Approximate number of htids to compare at once (default: %(default)s)",
+    )
+    parser.add_argument("--overwrite", help="Replace existing output files", action="store_true")
+    args = parser.parse_args()
+
+    full_files = args.files or sorted(DATA_DIR.glob("hathi_full_*.txt.gz"))
+    if args.output and len(full_files) != 2:
+        parser.error("--output can only be used when comparing two files")
+    main(full_files, args.output, args.output_dir, args.range_size, args.overwrite)
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+Count the number of volumes updated in each daily HathiTrust update file,
+for all of HathiTrust and for volumes included in PPA, and save the counts
+in the format of `data/hathi_update_counts.csv`.
+
+Update files are independent, so they are counted in parallel across a
+pool of worker processes. Empty update files are skipped, so they have no
+row in the output. The PPA HathiTrust ids are sent to each worker
+once, when it starts, rather than with every file.
+
+In incremental mode, a fingerprint (size and modification time) of each
+counted update file is kept in a state file next to the output, along with
+the full snapshot and totals used for its percentages. Only new or changed
+files are counted, and their rows are merged into the existing output;
+rows for files that are unchanged (or no longer present locally) are kept
+as they are, so their percentages stay consistent with the snapshot they
+were computed against. Output can be CSV or Parquet, based on the file
+extension.
+
+In streaming mode, all update files are instead treated as a single lazy
+dataset, with the date derived from each row's source filename, and the
+counts are calculated in one query on the polars streaming engine. Memory
+use depends on the streaming batch size rather than the number of files.
+"""
+
+import argparse
+import json
+import os
+import pathlib
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import polars as pl
+
+import htid_keys
+from hathifiles import (
+    DATA_DIR,
+    is_empty,
+    load_field_list,
+    scan_hathifile,
+    scan_snapshot,
+    scan_update_files,
+    update_file_date,
+)
+
+PPA_METADATA = DATA_DIR.parent.parent / "ppa" / "ppa_work_metadata.csv"
+OUTPUT_FILE = DATA_DIR.parent.parent / "hathi_update_counts.csv"
+
+DEFAULT_WORKERS = min(8, os.cpu_count() or 1)
+#: number of rows per batch for the streaming engine; peak memory in streaming
+#: mode is roughly this many rows per thread
+DEFAULT_CHUNK_SIZE = 50_000
+
+# set in each worker process by init_worker
+_ppa_htids: pl.DataFrame | None = None
+_field_list: list[str] | None = None
+
+
+def load_ppa_htids(ppa_metadata: pathlib.Path = PPA_METADATA, with_keys: bool = False) -> pl.DataFrame:
+    """Load source ids for PPA works from HathiTrust. Ids are not
+    deduplicated, since a few excerpts are from the same volume
+    and each excerpt is counted. Use `with_keys` to add the shared
+    integer key for each id, as `htid_key`."""
+    ppa_htids = (
+        pl.read_csv(ppa_metadata)
+        .filter(pl.col("ppa_source").eq("HathiTrust"))
+        .select("ppa_source_id")
+    )
+    if with_keys:
+        ppa_htids = htid_keys.add_keys(ppa_htids, "ppa_source_id")
+    return ppa_htids
+
+
+def init_worker(ppa_htids: pl.DataFrame, field_list: list[str]):
+    global _ppa_htids, _field_list
+    _ppa_htids = ppa_htids
+    _field_list = field_list
+
+
+def count_updates(update_file: pathlib.Path) -> dict:
+    """Count all updated volumes and updated PPA volumes in one update file."""
+    update_df = scan_hathifile(update_file, _field_list).select("htid").collect()
+    # join with ppa data so we can count # ppa volumes that changed
+    ppa_updates_df = update_df.join(_ppa_htids, left_on="htid", right_on="ppa_source_id", how="inner")
+    return {
+        "date": update_file_date(update_file.name),
+        "num_updated": update_df.height,
+        "ppa_updated": ppa_updates_df.height,
+    }
+
+
+def compute_update_counts(
+    update_files: list[pathlib.Path],
+    ppa_htids: pl.DataFrame,
+    field_list: list[str] | None = None,
+    workers: int = DEFAULT_WORKERS,
+) -> pl.DataFrame:
+    """Count updates for a set of update files in parallel; returns
+    a dataframe with date, num_updated and ppa_updated, sorted by date.
+    Empty files are skipped."""
+    field_list = field_list or load_field_list()
+    update_files = [update_file for update_file in update_files if not is_empty(update_file)]
+    # divide polars threads among the workers, which inherit the environment
+    # when they start; update files are small, so the pool provides the parallelism
+    polars_threads = os.environ.get("POLARS_MAX_THREADS")
+    os.environ["POLARS_MAX_THREADS"] = str(max(1, (os.cpu_count() or 1) // workers))
+    try:
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            # polars is multithreaded and not safe to fork
+            mp_context=get_context("spawn"),
+            initializer=init_worker,
+            initargs=(ppa_htids, field_list),
+        ) as executor:
+            update_data = list(executor.map(count_updates, update_files, chunksize=4))
+    finally:
+        if polars_threads is None:
+            del os.environ["POLARS_MAX_THREADS"]
+        else:
+            os.environ["POLARS_MAX_THREADS"] = polars_threads
+
+    return pl.DataFrame(
+        update_data, schema={"date": pl.Date, "num_updated": pl.Int64, "ppa_updated": pl.Int64}
+    ).sort("date")
+
+
+def stream_update_counts(
+    update_files: list[pathlib.Path],
+    ppa_htids: pl.DataFrame,
+    field_list: list[str] | None = None,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+) -> pl.DataFrame:
+    """Count updates for a set of update files in a single streaming query;
+    returns the same dataframe as :meth:`compute_update_counts`.
+    Empty files are not scanned, and are skipped."""
+    if not update_files:
+        return pl.DataFrame(schema={"date": pl.Date, "num_updated": pl.Int64, "ppa_updated": pl.Int64})
+
+    # number of PPA works for each htid, since a few excerpts are from the same volume;
+    # summing these gives the same count as joining update rows to PPA works
+    ppa_counts = ppa_htids.group_by("ppa_source_id").agg(ppa_works=pl.len().cast(pl.Int64)).lazy()
+    counts = (
+        scan_update_files(update_files, field_list)
+        .select("htid", "date")
+        .join(ppa_counts, left_on="htid", right_on="ppa_source_id", how="left")
+        .group_by("date")
+        .agg(
+            num_updated=pl.len().cast(pl.Int64),
+            ppa_updated=pl.col("ppa_works").sum().cast(pl.Int64),
+        )
+    )
+    with pl.Config(streaming_chunk_size=chunk_size):
+        return counts.collect(engine="streaming").sort("date")
+
+
+def add_percentages(
+    update_counts_df: pl.DataFrame, total_ht_vols: int | pl.Expr, ppa_ht_total: int | pl.Expr
+) -> pl.DataFrame:
+    """Calculate percentages updated for all of HathiTrust and all of PPA.
+    Totals can be numbers or expressions (i.e., per-row totals)."""
+    return update_counts_df.with_columns(
+        pct_updated=pl.col("num_updated").truediv(total_ht_vols),
+        pct_ppa_updated=pl.col("ppa_updated").truediv(ppa_ht_total),
+    )
+
+
+def file_fingerprint(path: pathlib.Path) -> dict:
+    stat = path.stat()
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+
+def state_path(output: pathlib.Path) -> pathlib.Path:
+    """Path for the incremental state file for an output file, e.g.
+    `hathi_update_counts.csv` → `hathi_update_counts.state.json`."""
+    return output.with_suffix(".state.json")
+
+
+def read_counts(output: pathlib.Path) -> pl.DataFrame:
+    if output.suffix == ".parquet":
+        return pl.read_parquet(output)
+    return pl.read_csv(output, schema_overrides={"date": pl.Date})
+
+
+def write_counts(update_counts_df: pl.DataFrame, output: pathlib.Path):
+    if output.suffix == ".parquet":
+        update_counts_df.write_parquet(output)
+    else:
+        update_counts_df.write_csv(output)
+
+
+def update_counts_incremental(
+    update_files: list[pathlib.Path],
+    output: pathlib.Path,
+    full_file: pathlib.Path,
+    total_ht_vols: int,
+    ppa_ht_total: int,
+    count_files: Callable[[list[pathlib.Path]], pl.DataFrame],
+) -> pl.DataFrame:
+    """Count updates for new or changed update files only, using `count_files`
+    (e.g., :meth:`compute_update_counts` with the PPA ids), and merge them
+    into the existing output. Returns the merged counts."""
+    state_file = state_path(output)
+    state = {}
+    if state_file.exists() and output.exists():
+        with state_file.open() as filehandle:
+            state = json.load(filehandle)
+
+    fingerprints = {path.name: file_fingerprint(path) for path in update_files}
+    changed_files = [
+        path for path in update_files
+        if state.get(path.name, {}).get("fingerprint") != fingerprints[path.name]
+    ]
+    print(f"{len(changed_files):,} new or changed update files of {len(update_files):,}")
+    if not changed_files:
+        return read_counts(output) if output.exists() else pl.DataFrame()
+
+    new_counts_df = add_percentages(
+        count_files(changed_files),
+        total_ht_vols,
+        ppa_ht_total,
+    )
+    if output.exists() and state:
+        # replace rows for all recounted files, including any that are now empty
+        changed_dates = pl.Series([update_file_date(path.name) for path in changed_files], dtype=pl.Date)
+        existing_df = read_counts(output).filter(~pl.col("date").is_in(changed_dates.implode()))
+        new_counts_df = pl.concat([existing_df, new_counts_df], how="vertical_relaxed").sort("date")
+    write_counts(new_counts_df, output)
+
+    for path in changed_files:
+        state[path.name] = {
+            "fingerprint": fingerprints[path.name],
+            "snapshot": full_file.name,
+            "total_ht_vols": total_ht_vols,
+            "ppa_ht_total": ppa_ht_total,
+        }
+    # write to a temporary file and rename, so an interrupted run can't corrupt it
+    tmp_file = state_file.with_name(f"{state_file.name}.tmp")
+    with tmp_file.open("w") as filehandle:
+        json.dump(state, filehandle, indent=2, sort_keys=True)
+    tmp_file.replace(state_file)
+    return new_counts_df
+
+
+def main(
+    data_dir: pathlib.Path = DATA_DIR,
+    full_file: pathlib.Path | None = None,
+    ppa_metadata: pathlib.Path = PPA_METADATA,
+    output: pathlib.Path = OUTPUT_FILE,
+    workers: int = DEFAULT_WORKERS,
+    incremental: bool = False,
+    streaming: bool = False,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+):
+    # use the most recent full file for total number of volumes
+    full_file = full_file or max(data_dir.glob("hathi_full_*.txt.gz"))
+    total_ht_vols = scan_snapshot(full_file).select(pl.len()).collect().item()
+    ppa_htids = load_ppa_htids(ppa_metadata)
+    # use unique for the total, since a few excerpts are from the same volume
+    ppa_ht_total = ppa_htids["ppa_source_id"].n_unique()
+
+    def count_files(update_files: list[pathlib.Path]) -> pl.DataFrame:
+        if streaming:
+            return stream_update_counts(update_files, ppa_htids, chunk_size=chunk_size)
+        return compute_update_counts(update_files, ppa_htids, workers=workers)
+
+    update_files = sorted(data_dir.glob("hathi_upd_*.txt.gz"))
+    mode = "in a single streaming query" if streaming else f"with {workers} workers"
+    print(
+        f"Counting updates in {len(update_files):,} files {mode}; "
+        f"{total_ht_vols:,} total volumes in {full_file.name}"
+    )
+    if incremental:
+        update_counts_df = update_counts_incremental(
+            update_files, output, full_file, total_ht_vols, ppa_ht_total, count_files
+        )
+    else:
+        update_counts_df = count_files(update_files)
+        write_counts(add_percentages(update_counts_df, total_ht_vols, ppa_ht_total), output)
+    print(f"Saved counts for {update_counts_df.height:,} dates to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Count updated volumes in HathiTrust daily update files")
+    parser.add_argument(
+        "-d", "--data-dir", help=f"Directory with hathifiles (default: {DATA_DIR})",
+        type=pathlib.Path, default=DATA_DIR,
+    )
+    parser.add_argument(
+        "--full", help="Full hathifile for total volume count (default: most recent)", type=pathlib.Path
+    )
+    parser.add_argument(
+        "--ppa-metadata", help="PPA work metadata CSV (default: %(default)s)",
+        type=pathlib.Path, default=PPA_METADATA,
+    )
+    parser.add_argument(
+        "-o", "--output", help="Output file (default: %(default)s)", type=pathlib.Path, default=OUTPUT_FILE
+    )
+    parser.add_argument(
+        "-w", "--workers", help="Number of worker processes (default: %(default)s)",
+        type=int, default=DEFAULT_WORKERS,
+    )
+    parser.add_argument(
+        "-i", "--incremental", help="Only count new or changed update files and merge into existing output",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-s", "--streaming", help="Count all update files in a single streaming query instead of a process pool",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--chunk-size", help="Rows per batch in streaming mode; lower to reduce memory use (default: %(default)s)",
+        type=int, default=DEFAULT_CHUNK_SIZE,
+    )
+    args = parser.parse_args()
+
+    main(
+        args.data_dir, args.full, args.ppa_metadata, args.output, args.workers,
+        args.incremental, args.streaming, args.chunk_size,
+    )
@@ -0,0 +1,282 @@
+"""
+Utilities for loading HathiTrust hathifiles (tab-delimited, gzipped
+full and update files) with polars, and for converting them to
+Parquet so later analysis doesn't have to decompress and parse them again.
+
+Full snapshots can be loaded with `scan_snapshot`, which builds a Parquet
+copy in a snapshot cache the first time a file is loaded and reuses it
+until the file's size or modification time changes.
+
+Large gzipped hathifiles can also be read with `read_tsv_parallel`, which
+uses an access-point index (see `gzip_index.py`) to decompress and parse
+chunks of the file in parallel.
+
+Run as a script to convert files that have already been downloaded.
+"""
+
+import argparse
+import datetime
+import gzip
+import pathlib
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import polars as pl
+
+import gzip_index
+import htid_keys
+
+DATA_DIR = pathlib.Path(__file__).parent.parent.resolve() / "data" / "hathi" / "updates"
+
+FIELD_LIST_FILENAME = "hathi_field_list.txt"
+
+#: types for hathifile fields that are not strings; all other fields are loaded as strings
+FIELD_TYPES = {
+    "ht_bib_key": pl.Int64,
+    "us_gov_doc_flag": pl.Int8,
+    "rights_date_used": pl.Int32,
+}
+#: timestamp fields and their format
+TIMESTAMP_FIELDS = {"rights_timestamp": "%Y-%m-%d %H:%M:%S"}
+
+UPDATE_FILE_DATE = re.compile(r"^hathi_upd_(\d{8})\.txt\.gz$")
+
+#: directory (relative to the hathifiles) for cached Parquet copies of snapshots
+SNAPSHOT_CACHE_DIRNAME = ".snapshots"
+
+#: options for loading hathifiles as TSV
+TSV_OPTIONS = {
+    "separator": "\t",
+    "quote_char": None,  # do not treat " as escape character, since it is used in some content
+    "encoding": "utf8",
+}
+
+#: parquet row group size; smaller groups allow finer-grained skipping by htid
+ROW_GROUP_SIZE = 128_000
+
+
+def load_field_list(data_dir: pathlib.Path = DATA_DIR) -> list[str]:
+    """Load the list of hathifile field names, in order."""
+    return (data_dir / FIELD_LIST_FILENAME).read_text().split()
+
+
+def update_file_date(filename: str) -> datetime.date | None:
+    """Date for a daily update file, based on the filename;
+    `None` for any other file."""
+    match = UPDATE_FILE_DATE.match(filename)
+    if match:
+        return datetime.datetime.strptime(match.group(1), "%Y%m%d").date()
+
+
+def parquet_path(hathifile: pathlib.Path) -> pathlib.Path:
+    """Path for the Parquet copy of a hathifile, e.g.
+    `hathi_full_20250701.txt.gz` → `hathi_full_20250701.parquet`."""
+    return hathifile.with_name(hathifile.name.removesuffix(".gz").removesuffix(".txt") + ".parquet")
+
+
+def is_empty(hathifile: pathlib.Path) -> bool:
+    """Check whether a (possibly gzipped) hathifile has no content."""
+    opener = gzip.open if hathifile.suffix == ".gz" else open
+    with opener(hathifile, "rb") as filehandle:
+        return not filehandle.read(1)
+
+
+def scan_tsv(
+    hathifile: pathlib.Path | list[pathlib.Path],
+    field_list: list[str],
+    include_file_paths: str | None = None,
+) -> pl.LazyFrame:
+    """Lazily load one or more gzipped hathifiles as TSV, with typed columns.
+    A single empty file is loaded as an empty frame."""
+    schema = {field: pl.String for field in field_list}
+    # at least one update file is actually empty, which polars can't parse
+    if isinstance(hathifile, pathlib.Path) and is_empty(hathifile):
+        lazy_df = pl.LazyFrame(schema=schema)
+        if include_file_paths:
+            lazy_df = lazy_df.with_columns(pl.lit(str(hathifile)).alias(include_file_paths))
+    else:
+        lazy_df = pl.scan_csv(
+            hathifile,
+            has_header=False,
+            schema=schema,
+            include_file_paths=include_file_paths,
+            **TSV_OPTIONS,
+        )
+    return type_fields(lazy_df)
+
+
+def type_fields[Frame: (pl.DataFrame, pl.LazyFrame)](df: Frame) -> Frame:
+    """Convert hathifile fields loaded as strings to their types."""
+    columns = df.collect_schema().names()
+    return df.with_columns(
+        *[pl.col(field).cast(dtype, strict=False) for field, dtype in FIELD_TYPES.items() if field in columns],
+        *[
+            pl.col(field).str.to_datetime(fmt, strict=False)
+            for field, fmt in TIMESTAMP_FIELDS.items()
+            if field in columns
+        ],
+    )
+
+
+def read_tsv_parallel(
+    hathifile: pathlib.Path,
+    field_list: list[str] | None = None,
+    columns: list[str] | None = None,
+    workers: int = gzip_index.DEFAULT_WORKERS,
+) -> pl.DataFrame:
+    """Load a gzipped hathifile, decompressing and parsing line-aligned
+    chunks in parallel using the file's access-point index (built on
+    first use). Use `columns` to only keep some fields."""
+    field_list = field_list or load_field_list()
+    schema = {field: pl.String for field in field_list}
+    # several chunks per worker, so workers finishing early pick up more work
+    chunks = gzip_index.line_chunks(hathifile, workers * 4)
+
+    def read_chunk(chunk: tuple[int, int]) -> pl.DataFrame:
+        data = gzip_index.read_chunk(hathifile, *chunk)
+        return (
+            pl.scan_csv(data, has_header=False, schema=schema, **TSV_OPTIONS)
+            .select(columns or field_list)
+            .collect()
+        )
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        chunk_dfs = list(executor.map(read_chunk, chunks))
+    if not chunk_dfs:
+        return type_fields(pl.DataFrame(schema=schema).select(columns or field_list))
+    return type_fields(pl.concat(chunk_dfs))
+
+
+def scan_hathifile(hathifile: pathlib.Path, field_list: list[str] | None = None) -> pl.LazyFrame:
+    """Lazily load a hathifile, using the Parquet copy when there is one
+    so that only the selected columns are read."""
+    parquet_file = parquet_path(hathifile)
+    if parquet_file.exists():
+        return pl.scan_parquet(parquet_file)
+    return scan_tsv(hathifile, field_list or load_field_list())
+
+
+def scan_hathifiles(
+    hathifiles: list[pathlib.Path],
+    field_list: list[str] | None = None,
+    include_file_paths: str | None = None,
+) -> pl.LazyFrame:
+    """Lazily load a set of hathifiles as a single dataset, using Parquet
+    copies where there are any. Empty files are left out of the plan.
+    Use `include_file_paths` to add a column with the source file path
+    (the Parquet copy, where one is used)."""
+    field_list = field_list or load_field_list()
+    parquet_files = [parquet_path(hathifile) for hathifile in hathifiles if parquet_path(hathifile).exists()]
+    tsv_files = [
+        hathifile
+        for hathifile in hathifiles
+        if not parquet_path(hathifile).exists() and not is_empty(hathifile)
+    ]
+    lazy_dfs = []
+    if tsv_files:
+        lazy_dfs.append(scan_tsv(tsv_files, field_list, include_file_paths))
+    if parquet_files:
+        lazy_dfs.append(pl.scan_parquet(parquet_files, include_file_paths=include_file_paths))
+    if not lazy_dfs:
+        # no content at all; load an empty file to get a frame with the right schema
+        return scan_tsv(hathifiles[0], field_list, include_file_paths)
+    return pl.concat(lazy_dfs, how="vertical")
+
+
+def scan_update_files(
+    update_files: list[pathlib.Path],
+    field_list: list[str] | None = None,
+    with_keys: bool = False,
+) -> pl.LazyFrame:
+    """Lazily load a set of daily update files as a single dataset,
+    with a `date` column derived from the name of each row's file.
+    Use `with_keys` to add the shared integer key for each htid
+    (see `htid_keys.py`)."""
+    update_df = (
+        scan_hathifiles(update_files, field_list, include_file_paths="path")
+        .with_columns(date=pl.col("path").str.extract(r"hathi_upd_(\d{8})").str.to_date("%Y%m%d"))
+        .drop("path")
+    )
+    return htid_keys.add_keys(update_df) if with_keys else update_df
+
+
+def snapshot_path(hathifile: pathlib.Path, cache_dir: pathlib.Path | None = None) -> pathlib.Path:
+    """Path for the cached Parquet copy of a hathifile; the name includes
+    the file's size and modification time, so a changed file gets a new copy."""
+    cache_dir = cache_dir or hathifile.parent / SNAPSHOT_CACHE_DIRNAME
+    stat = hathifile.stat()
+    return cache_dir / f"{parquet_path(hathifile).stem}_{stat.st_size}_{stat.st_mtime_ns}.parquet"
+
+
+def scan_snapshot(
+    hathifile: pathlib.Path,
+    field_list: list[str] | None = None,
+    cache_dir: pathlib.Path | None = None,
+    with_keys: bool = False,
+) -> pl.LazyFrame:
+    """Lazily load a full hathifile snapshot from a columnar copy, so that
+    callers only pay for the columns they select; row counts come from
+    Parquet metadata without reading any data. Uses the Parquet copy made
+    at download time if it is current, otherwise builds a cached copy the
+    first time the file is loaded. Use `with_keys` to add the shared
+    integer key for each htid (see `htid_keys.py`)."""
+    parquet_file = parquet_path(hathifile)
+    if parquet_file.exists() and parquet_file.stat().st_mtime >= hathifile.stat().st_mtime:
+        snapshot_df = pl.scan_parquet(parquet_file)
+        return htid_keys.add_keys(snapshot_df) if with_keys else snapshot_df
+
+    snapshot_file = snapshot_path(hathifile, cache_dir)
+    if not snapshot_file.exists():
+        snapshot_file.parent.mkdir(parents=True, exist_ok=True)
+        # remove copies of previous versions of this file
+        for stale_file in snapshot_file.parent.glob(f"{parquet_file.stem}_*.parquet"):
+            stale_file.unlink()
+        print(f"Building snapshot cache for {hathifile.name}")
+        transcode(hathifile, field_list, snapshot_file)
+    snapshot_df = pl.scan_parquet(snapshot_file)
+    return htid_keys.add_keys(snapshot_df) if with_keys else snapshot_df
+
+
+def transcode(
+    hathifile: pathlib.Path,
+    field_list: list[str] | None = None,
+    parquet_file: pathlib.Path | None = None,
+) -> pathlib.Path:
+    """Convert a gzipped hathifile to a zstd-compressed Parquet file sorted
+    by htid, with row group statistics. The conversion runs on the polars
+    streaming engine, so a full hathifile does not need to fit in memory.
+    Writes the Parquet copy next to the hathifile unless `parquet_file`
+    is specified."""
+    parquet_file = parquet_file or parquet_path(hathifile)
+    # write to a temporary file so a partial conversion is never mistaken for a complete one
+    tmp_file = parquet_file.with_name(f"{parquet_file.name}.tmp")
+    scan_tsv(hathifile, field_list or load_field_list()).sort("htid").sink_parquet(
+        tmp_file,
+        compression="zstd",
+        statistics=True,
+        row_group_size=ROW_GROUP_SIZE,
+        engine="streaming",
+    )
+    tmp_file.replace(parquet_file)
+    return parquet_file
+
+
+def main(hathifiles: list[pathlib.Path], overwrite: bool = False):
+    for hathifile in hathifiles:
+        if parquet_path(hathifile).exists() and not overwrite:
+            print(f"{parquet_path(hathifile).name} already exists; skipping")
+            continue
+        print(f"Converting {hathifile.name} to Parquet")
+        transcode(hathifile)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert downloaded hathifiles to Parquet")
+    parser.add_argument(
+        "files", help="Hathifiles to convert (default: all in data/hathi/updates)",
+        type=pathlib.Path, nargs="*",
+    )
+    parser.add_argument("--overwrite", help="Replace existing Parquet files", action="store_true")
+    args = parser.parse_args()
+
+    main(args.files or sorted(DATA_DIR.glob("hathi_*.txt.gz")), args.overwrite)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Change-history index for HathiTrust volumes: for each htid, the dates
+of the daily update files it appears in, so the history for a volume
+can be looked up without rescanning every `hathi_upd_*` file.
+
+The index is a set of Parquet segments of (htid, date) rows, each sorted
+by htid and written with small row groups and min/max statistics, so a
+lookup only reads the row groups whose htid range could contain the ids
+requested. Each update adds one segment for the newly downloaded files;
+segments are merged into one when there are too many of them, or when an
+update file that was already indexed has changed upstream. History is
+kept for update files that are later pruned from the download directory.
+
+Run as a script to update the index, or to look up histories for
+individual volumes, a list of ids, or all PPA volumes from HathiTrust.
+"""
+
+import argparse
+import json
+import pathlib
+
+import polars as pl
+
+from hathi_update_counts import PPA_METADATA, file_fingerprint, load_ppa_htids
+from hathifiles import DATA_DIR, load_field_list, scan_update_files, update_file_date
+
+INDEX_DIR = DATA_DIR.parent / "htid_history"
+
+STATE_FILENAME = "state.json"
+
+#: rows per parquet row group; small groups mean a lookup reads little beyond the rows it needs
+ROW_GROUP_SIZE = 16_384
+
+#: merge segments into one when an update leaves more than this many
+MAX_SEGMENTS = 8
+
+
+def load_state(index_dir: pathlib.Path = INDEX_DIR) -> dict:
+    """Load the index state: fingerprints of indexed update files and
+    the current list of segment files."""
+    state_file = index_dir / STATE_FILENAME
+    if state_file.exists():
+        return json.loads(state_file.read_text())
+    return {"files": {}, "segments": []}
+
+
+def save_state(state: dict, index_dir: pathlib.Path = INDEX_DIR):
+    state_file = index_dir / STATE_FILENAME
+    tmp_file = state_file.with_name(f"{state_file.name}.tmp")
+    tmp_file.write_text(json.dumps(state, indent=2))
+    tmp_file.replace(state_file)
+
+
+def write_segment(history_df: pl.LazyFrame, index_dir: pathlib.Path, state: dict) -> str:
+    """Sort (htid, date) rows and write them as a new segment; returns the segment filename."""
+    number = max((int(name.split("_")[1].split(".")[0]) for name in state["segments"]), default=0) + 1
+    segment = f"segment_{number:05d}.parquet"
+    tmp_file = index_dir / f"{segment}.tmp"
+    history_df.unique().sort("htid", "date").sink_parquet(
+        tmp_file,
+        compression="zstd",
+        statistics=True,
+        row_group_size=ROW_GROUP_SIZE,
+        engine="streaming",
+    )
+    tmp_file.replace(index_dir / segment)
+    return segment
+
+
+def scan_index(index_dir: pathlib.Path = INDEX_DIR) -> pl.LazyFrame:
+    """Lazily load all (htid, date) rows in the index."""
+    segments = [index_dir / segment for segment in load_state(index_dir)["segments"]]
+    if not segments:
+        return pl.LazyFrame(schema={"htid": pl.String, "date": pl.Date})
+    return pl.scan_parquet(segments)
+
+
+def compact_index(index_dir: pathlib.Path = INDEX_DIR, drop_dates: set | None = None) -> str | None:
+    """Merge all segments into a single sorted segment, leaving out rows
+    for any dates in `drop_dates`. Returns the new segment filename."""
+    state = load_state(index_dir)
+    if not state["segments"]:
+        return None
+    history_df = scan_index(index_dir)
+    if drop_dates:
+        history_df = history_df.filter(~pl.col("date").is_in(sorted(drop_dates)))
+    old_segments = state["segments"]
+    segment = write_segment(history_df, index_dir, state)
+    # record the new segment before removing the old ones, so the state never refers to missing files
+    state["segments"] = [segment]
+    save_state(state, index_dir)
+    for old_segment in old_segments:
+        (index_dir / old_segment).unlink(missing_ok=True)
+    return segment
+
+
+def update_index(
+    update_files: list[pathlib.Path],
+    index_dir: pathlib.Path = INDEX_DIR,
+    field_list: list[str] | None = None,
+) -> list[pathlib.Path]:
+    """Add any update files that are new or have changed since they were
+    indexed. Returns the files that were indexed."""
+    index_dir.mkdir(parents=True, exist_ok=True)
+    state = load_state(index_dir)
+    pending = [
+        update_file
+        for update_file in update_files
+        if state["files"].get(update_file.name) != file_fingerprint(update_file)
+    ]
+    if not pending:
+        return []
+    # files that were indexed before and have changed upstream replace their earlier rows
+    changed_dates = {update_file_date(update_file.name) for update_file in pending if update_file.name in state["files"]}
+    if changed_dates:
+        compact_index(index_dir, drop_dates=changed_dates)
+        state = load_state(index_dir)
+
+    segment = write_segment(
+        scan_update_files(pending, field_list or load_field_list()).select("htid", "date"),
+        index_dir,
+        state,
+    )
+    state["segments"].append(segment)
+    state["files"].update({update_file.name: file_fingerprint(update_file) for update_file in pending})
+    save_state(state, index_dir)
+
+    if len(state["segments"]) > MAX_SEGMENTS:
+        compact_index(index_dir)
+    return pending
+
+
+def lookup(htids: list[str] | pl.Series, index_dir: pathlib.Path = INDEX_DIR) -> pl.DataFrame:
+    """Change histories for a set of volumes: one row per unique htid,
+    with the sorted list of dates it was updated (empty if never)."""
+    htids_df = pl.DataFrame({"htid": htids}, schema={"htid": pl.String}).unique(maintain_order=True)
+    history_df = (
+        scan_index(index_dir)
+        .filter(pl.col("htid").is_in(htids_df["htid"].to_list()))
+        .group_by("htid")
+        .agg(dates=pl.col("date").sort())
+        .collect()
+    )
+    return htids_df.join(history_df, on="htid", how="left").with_columns(
+        pl.col("dates").fill_null(pl.lit([], dtype=pl.List(pl.Date)))
+    )
+
+
+def history(htid: str, index_dir: pathlib.Path = INDEX_DIR) -> list:
+    """Sorted list of dates a single volume was updated."""
+    return lookup([htid], index_dir)["dates"][0].to_list()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and query the htid change-history index")
+    parser.add_argument(
+        "--index-dir", type=pathlib.Path, default=INDEX_DIR, help="Index directory (default: %(default)s)"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    update_parser = subparsers.add_parser("update", help="Index new and changed update files")
+    update_parser.add_argument(
+        "-d", "--data-dir", type=pathlib.Path, default=DATA_DIR,
+        help="Directory with hathifile update files (default: %(default)s)",
+    )
+    subparsers.add_parser("compact", help="Merge index segments into one")
+    lookup_parser = subparsers.add_parser("lookup", help="Look up change histories")
+    lookup_parser.add_argument("htids", nargs="*", help="Volume ids to look up")
+    lookup_parser.add_argument(
+        "--batch", type=pathlib.Path, help="Text file with one htid per line, or CSV file with an htid column"
+    )
+    lookup_parser.add_argument("--column", default="htid", help="Id column for a CSV batch file (default: %(default)s)")
+    lookup_parser.add_argument(
+        "--ppa", action="store_true", help=f"Look up all HathiTrust volumes in {PPA_METADATA.name}"
+    )
+    lookup_parser.add_argument("-o", "--output", type=pathlib.Path, help="Save results to a CSV or Parquet file")
+    args = parser.parse_args()
+
+    if args.command == "update":
+        update_files = sorted(args.data_dir.glob("hathi_upd_*.txt.gz"))
+        indexed = update_index(update_files, args.index_dir)
+        print(f"Indexed {len(indexed)} of {len(update_files)} update files")
+    elif args.command == "compact":
+        compact_index(args.index_dir)
+    elif args.command == "lookup":
+        htids = list(args.htids)
+        if args.batch:
+            if args.batch.suffix == ".csv":
+                htids.extend(pl.read_csv(args.batch, columns=[args.column])[args.column].to_list())
+            else:
+                htids.extend(line.strip() for line in args.batch.read_text().splitlines() if line.strip())
+        if args.ppa:
+            htids.extend(load_ppa_htids()["ppa_source_id"].to_list())
+        if not htids:
+            parser.error("no htids to look up")
+        history_df = lookup(htids, args.index_dir)
+        if args.output:
+            if args.output.suffix == ".parquet":
+                history_df.write_parquet(args.output)
+            else:
+                # csv can't store lists; use ISO dates separated by semicolons
+                history_df.with_columns(
+                    pl.col("dates").list.eval(pl.element().dt.to_string("%Y-%m-%d")).list.join(";")
+                ).write_csv(args.output)
+            print(f"Saved change histories for {history_df.height:,} volumes to {args.output}")
+        else:
+            for row in history_df.iter_rows(named=True):
+                print(f"{row['htid']}\t{', '.join(str(date) for date in row['dates']) or '-'}")
+
+
+if __name__ == "__main__":
+    main()
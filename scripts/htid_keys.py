@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Persistent dictionary of HathiTrust volume ids to dense 32-bit integer
+keys, shared by all datasets (hathifiles, PPA metadata, rsync logs,
+PREMIS events), so tables from any of them can carry a compact integer
+id that means the same volume everywhere.
+
+Keys are assigned once and never change: htids that are not in the
+dictionary yet are given the next available keys (in sorted order) and
+the dictionary is saved, so the same htid has the same key in every
+dataset and every session. The dictionary is a two-column Parquet file;
+a lock file keeps concurrent sessions from assigning keys at the same time.
+
+Run as a script to add ids from data files to the dictionary ahead of time.
+"""
+
+import argparse
+import fcntl
+import pathlib
+from contextlib import contextmanager
+
+import polars as pl
+
+KEYS_FILE = pathlib.Path(__file__).parent.parent.resolve() / "data" / "htid_keys.parquet"
+
+KEY_TYPE = pl.Int32
+
+KEYS_SCHEMA = {"htid": pl.String, "htid_key": KEY_TYPE}
+
+
+@contextmanager
+def locked(keys_file: pathlib.Path):
+    """Hold an exclusive lock on the dictionary while assigning keys."""
+    keys_file.parent.mkdir(parents=True, exist_ok=True)
+    with keys_file.with_name(f"{keys_file.name}.lock").open("w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def load_keys(keys_file: pathlib.Path = KEYS_FILE) -> pl.DataFrame:
+    """Load the full htid dictionary."""
+    if keys_file.exists():
+        return pl.read_parquet(keys_file)
+    return pl.DataFrame(schema=KEYS_SCHEMA)
+
+
+def assign_keys(htids: pl.Series | pl.LazyFrame, keys_file: pathlib.Path = KEYS_FILE) -> pl.DataFrame:
+    """Add any htids that are not in the dictionary yet, and return the
+    updated dictionary. `htids` can be a series or a lazy frame with an
+    `htid` column, in which case only that column is read."""
+    if isinstance(htids, pl.Series):
+        htids = htids.rename("htid").to_frame().lazy()
+    with locked(keys_file):
+        keys_df = load_keys(keys_file)
+        new_df = (
+            htids.select(pl.col("htid").cast(pl.String))
+            .drop_nulls()
+            .unique()
+            .join(keys_df.lazy(), on="htid", how="anti")
+            .sort("htid")
+            .collect()
+        )
+        if new_df.is_empty():
+            return keys_df
+        next_key = 0 if keys_df.is_empty() else keys_df["htid_key"].max() + 1
+        keys_df = pl.concat(
+            [keys_df, new_df.with_columns(htid_key=pl.int_range(next_key, next_key + new_df.height, dtype=KEY_TYPE))]
+        )
+        tmp_file = keys_file.with_name(f"{keys_file.name}.tmp")
+        keys_df.write_parquet(tmp_file, compression="zstd")
+        tmp_file.replace(keys_file)
+    return keys_df
+
+
+def add_keys[Frame: (pl.DataFrame, pl.LazyFrame)](
+    df: Frame,
+    column: str = "htid",
+    key_column: str = "htid_key",
+    keys_file: pathlib.Path = KEYS_FILE,
+) -> Frame:
+    """Add a column with the integer key for the htids in `column`,
+    assigning keys to any htids that are new to the dictionary."""
+    keys_df = assign_keys(df.lazy().select(pl.col(column).alias("htid")), keys_file).rename(
+        {"htid": column, "htid_key": key_column}
+    )
+    return df.join(keys_df.lazy() if isinstance(df, pl.LazyFrame) else keys_df, on=column, how="left")
+
+
+def decode_keys[Frame: (pl.DataFrame, pl.LazyFrame)](
+    df: Frame,
+    key_column: str = "htid_key",
+    column: str = "htid",
+    keys_file: pathlib.Path = KEYS_FILE,
+) -> Frame:
+    """Add a column with the htid for the integer keys in `key_column`."""
+    keys_df = load_keys(keys_file).rename({"htid": column, "htid_key": key_column})
+    return df.join(keys_df.lazy() if isinstance(df, pl.LazyFrame) else keys_df, on=key_column, how="left")
+
+
+def main(files: list[pathlib.Path], column: str = "htid", keys_file: pathlib.Path = KEYS_FILE):
+    before = load_keys(keys_file).height
+    for data_file in files:
+        if data_file.suffix == ".parquet":
+            htids = pl.scan_parquet(data_file).select(pl.col(column).alias("htid"))
+        else:
+            htids = pl.scan_csv(data_file, infer_schema=False).select(pl.col(column).alias("htid"))
+        total = assign_keys(htids, keys_file).height
+        print(f"{data_file.name}: {total - before:,} new htids")
+        before = total
+    print(f"{before:,} htids in {keys_file}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add htids from data files to the shared integer key dictionary")
+    parser.add_argument("files", type=pathlib.Path, nargs="*", help="CSV or Parquet files with an htid column")
+    parser.add_argument("--column", default="htid", help="Name of the htid column (default: %(default)s)")
+    parser.add_argument(
+        "--keys-file", type=pathlib.Path, default=KEYS_FILE, help="Dictionary file (default: %(default)s)"
+    )
+    args = parser.parse_args()
+
+    main(args.files, args.column, args.keys_file)
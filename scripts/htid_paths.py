@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Convert HathiTrust volume ids to and from the paths and filenames used
+for HathiTrust data, as polars expressions, so whole columns of ids or
+paths are converted at once instead of a Python call per row.
+
+HathiTrust data is stored in pairtree layout under a directory for each
+id prefix: `mdp.39015012345678` is stored in
+`mdp/pairtree_root/39/01/50/12/34/56/78/39015012345678/`. The part of the
+id after the prefix is encoded following the pairtree specification
+(as in `pairtree.id_encode`): characters that are not visible ASCII and
+`"*+,<=>?\\^|` are replaced with `^` and their hex UTF-8 bytes, then `/`,
+`:`, and `.` are replaced with `=`, `+`, and `,`; e.g. the ARK
+`uc2.ark:/13960/t3pv6hh4c` is stored in directory `ark+=13960=t3pv6hh4c`.
+Datasets built from HathiTrust volumes (such as HTRC extracted features
+and page-level genre data) name files with "clean" ids instead, where
+only `:` and `/` are replaced: `uc2.ark+=13960=t3pv6hh4c.json`.
+
+Run as a script to add htid and file type columns to a CSV of pairtree paths.
+"""
+
+import argparse
+import pathlib
+
+import polars as pl
+
+#: characters that can appear in an encoded id as they are
+SAFE_CHARACTERS = r'[\x21-\x7e--["*+,<=>?\\^|]]'
+#: single-character substitutions made after hex encoding
+SUBSTITUTIONS = {"/": "=", ":": "+", ".": ","}
+#: substitutions for clean ids used in filenames
+CLEAN_SUBSTITUTIONS = {":": "+", "/": "="}
+
+
+def _replace_chars(value: pl.Expr, substitutions: dict[str, str]) -> pl.Expr:
+    return value.str.replace_many(list(substitutions), list(substitutions.values()))
+
+
+def _convert_some(values: pl.Series, needs_conversion: pl.Series, conversion: pl.Expr) -> pl.Series:
+    """Apply a conversion to only the values that need it; most ids have no
+    characters to hex encode, so this skips the slower list operations for them."""
+    if not needs_conversion.any():
+        return values
+    converted = values.filter(needs_conversion).to_frame("value").select(conversion).to_series()
+    return values.scatter(needs_conversion.arg_true(), converted)
+
+
+def _hex_encode(ids: pl.Series) -> pl.Series:
+    # split ids into runs of safe characters and single characters to hex encode
+    hex_encoded = (
+        pl.col("value")
+        .str.extract_all(f"{SAFE_CHARACTERS}+|(?s:.)")
+        .list.eval(
+            pl.when(pl.element().str.contains(f"^{SAFE_CHARACTERS}"))
+            .then(pl.element())
+            .otherwise(pl.element().str.encode("hex").str.replace_all("(..)", "^$1"))
+        )
+        .list.join("")
+    )
+    return _convert_some(ids, ids.str.contains(f"[^{SAFE_CHARACTERS[1:]}"), hex_encoded)
+
+
+def _hex_decode(ids: pl.Series) -> pl.Series:
+    # split into runs of hex encoded bytes and of plain text, since one character
+    # can be several bytes; plain text is hex encoded too, so every run decodes the same way
+    hex_decoded = (
+        pl.col("value")
+        .str.extract_all(r"(?:\^[0-9a-fA-F]{2})+|[^^]+")
+        .list.eval(
+            pl.when(pl.element().str.starts_with("^"))
+            .then(pl.element().str.replace_all("^", "", literal=True))
+            .otherwise(pl.element().str.encode("hex"))
+            .str.decode("hex")
+            .cast(pl.String)
+        )
+        .list.join("")
+    )
+    return _convert_some(ids, ids.str.contains("^", literal=True), hex_decoded)
+
+
+def encode_id(item_id: pl.Expr) -> pl.Expr:
+    """Expression to encode ids for pairtree paths, e.g. `ark:/13960/t3pv6hh4c`
+    → `ark+=13960=t3pv6hh4c`."""
+    hex_encoded = item_id.map_batches(_hex_encode, return_dtype=pl.String, is_elementwise=True)
+    return _replace_chars(hex_encoded, SUBSTITUTIONS)
+
+
+def decode_id(encoded_id: pl.Expr) -> pl.Expr:
+    """Expression to decode ids from pairtree paths; the reverse of `encode_id`."""
+    hex_encoded = _replace_chars(encoded_id, {value: char for char, value in SUBSTITUTIONS.items()})
+    return hex_encoded.map_batches(_hex_decode, return_dtype=pl.String, is_elementwise=True)
+
+
+def htid_path(htid: pl.Expr, filename: str | None = None) -> pl.Expr:
+    """Expression for the pairtree directory of a volume, relative to the
+    data directory, e.g. `mdp.39015012345678` → `mdp/pairtree_root/39/01/50/12/34/56/78/39015012345678`.
+    With `filename`, the path to a file in the directory, where `{id}` is
+    replaced with the encoded id, e.g. `"{id}.zip"`."""
+    prefix = htid.str.extract(r"^([^.]+)\.")
+    encoded_id = encode_id(htid.str.extract(r"^[^.]+\.(?s:(.*))$"))
+    # pairtree directories are two characters each; the last can be one
+    shorties = encoded_id.str.replace_all("(..)", "$1/").str.strip_suffix("/")
+    parts = [prefix, pl.lit("pairtree_root"), shorties, encoded_id]
+    if filename is not None:
+        pieces = filename.split("{id}")
+        parts.append(pl.concat_str([pl.lit(pieces[0]), *(part for piece in pieces[1:] for part in [encoded_id, pl.lit(piece)])]))
+    return pl.concat_str(parts, separator="/")
+
+
+def path_htid(path: pl.Expr) -> pl.Expr:
+    """Expression for the htid of a volume from a path to its pairtree
+    directory or a file in it (relative to the data directory); e.g.
+    `inu/pairtree_root/39/00/00/02/41/94/84/39000002419484/39000002419484.mets.xml`
+    → `inu.39000002419484`."""
+    prefix = path.str.split_exact("/", 1).struct.field("field_0")
+    # the encoded id is the object directory name; it can't contain a period,
+    # so it is also the start of each filename in the directory
+    encoded_id = _path_name(path).str.split_exact(".", 1).struct.field("field_0")
+    return pl.concat_str([prefix, decode_id(encoded_id)], separator=".")
+
+
+def path_suffix(path: pl.Expr) -> pl.Expr:
+    """Expression for all the suffixes of a filename, e.g. `.mets.xml`."""
+    return _path_name(path).str.extract(r"(\..*)$").fill_null("")
+
+
+def _path_name(path: pl.Expr) -> pl.Expr:
+    return path.str.strip_suffix("/").str.extract(r"([^/]+)$")
+
+
+def clean_htid(htid: pl.Expr) -> pl.Expr:
+    """Expression for the clean form of an htid used in filenames, e.g.
+    `uc2.ark:/13960/t3pv6hh4c` → `uc2.ark+=13960=t3pv6hh4c`."""
+    return _replace_chars(htid, CLEAN_SUBSTITUTIONS)
+
+
+def unclean_htid(clean_id: pl.Expr) -> pl.Expr:
+    """Expression for the htid from its clean form; the reverse of `clean_htid`."""
+    return _replace_chars(clean_id, {value: char for char, value in CLEAN_SUBSTITUTIONS.items()})
+
+
+def main(input_file: pathlib.Path, output: pathlib.Path, column: str = "filename"):
+    paths_df = pl.scan_csv(input_file, infer_schema=False).with_columns(
+        htid=path_htid(pl.col(column)), file_type=path_suffix(pl.col(column))
+    )
+    paths_df.sink_csv(output)
+    print(f"Saved {input_file.name} with htids to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add htids to a CSV of HathiTrust pairtree paths")
+    parser.add_argument("input", type=pathlib.Path, help="CSV file with a column of pairtree paths")
+    parser.add_argument("-o", "--output", type=pathlib.Path, required=True, help="Output CSV file")
+    parser.add_argument("--column", default="filename", help="Name of the path column (default: %(default)s)")
+    args = parser.parse_args()
+
+    main(args.input, args.output, args.column)
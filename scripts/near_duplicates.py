@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+"""
+Match near-duplicate pages between two versions of the PPA page corpus,
+to tell pages whose text changed slightly (e.g. OCR corrections) apart
+from pages that were replaced, without comparing every pair of pages.
+
+Each page's text is split into overlapping word shingles, and a MinHash
+signature is computed from the shingle hashes, using one seeded hash
+function per signature position. Signatures are computed in batches as
+each corpus is read (see `ppa_corpus.py`) and only the signatures are
+kept. Candidate pairs are found with locality-sensitive hashing: the
+signature is split into bands, and pages in the same work whose band
+values are identical for any band are paired. The similarity score for
+each pair is the fraction of matching signature positions, which
+estimates the Jaccard similarity of the two pages' shingle sets.
+Signatures use polars' built-in hash, which is not guaranteed to be
+stable across polars versions, so they are only compared within a run.
+
+Run as a script to match pages between two corpus exports.
+"""
+
+import argparse
+import pathlib
+import tempfile
+
+import polars as pl
+
+from ppa_corpus import DEFAULT_BATCH_SIZE, iter_pages
+
+#: number of MinHash values in each page signature
+DEFAULT_NUM_PERM = 64
+#: number of LSH bands; pages with similarity s are paired with probability
+#: 1 - (1 - s^r)^b for b bands of r rows
+DEFAULT_BANDS = 16
+#: number of words in each shingle
+DEFAULT_SHINGLE_SIZE = 3
+#: minimum estimated similarity for a pair to be reported
+DEFAULT_THRESHOLD = 0.5
+#: number of groups of works matched separately, to limit memory use
+DEFAULT_PARTITIONS = 16
+
+
+def signature_columns(num_perm: int) -> list[str]:
+    return [f"minhash_{i}" for i in range(num_perm)]
+
+
+def shingles(size: int = DEFAULT_SHINGLE_SIZE) -> pl.Expr:
+    """Expression for the list of overlapping word shingles in page text,
+    case and punctuation aside. Pages with fewer words than the shingle
+    size have a single shingle."""
+    words = pl.col("text").str.to_lowercase().str.extract_all(r"\w+")
+    return words.list.eval(
+        pl.concat_str([pl.element().shift(-i) for i in range(size)], separator=" ", ignore_nulls=True).head(
+            pl.max_horizontal(pl.len() - size + 1, 1)
+        )
+    )
+
+
+def signatures(
+    pages_df: pl.DataFrame,
+    num_perm: int = DEFAULT_NUM_PERM,
+    shingle_size: int = DEFAULT_SHINGLE_SIZE,
+) -> pl.DataFrame:
+    """MinHash signatures for pages with `id`, `work_id`, and `text`;
+    pages with no words are left out."""
+    return (
+        pages_df.select("id", "work_id", shingle=shingles(shingle_size))
+        .explode("shingle")
+        .drop_nulls("shingle")
+        .group_by("id", "work_id")
+        .agg(
+            pl.col("shingle").hash(seed=i).min().alias(column)
+            for i, column in enumerate(signature_columns(num_perm))
+        )
+    )
+
+
+def corpus_signatures(
+    corpus_file: pathlib.Path,
+    output: pathlib.Path,
+    source: str | None = "HathiTrust",
+    num_perm: int = DEFAULT_NUM_PERM,
+    shingle_size: int = DEFAULT_SHINGLE_SIZE,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+) -> pathlib.Path:
+    """Compute signatures for every page in a corpus export, a batch at a
+    time, and save them to Parquet."""
+    part_dir = output.with_name(f"{output.name}.parts")
+    part_dir.mkdir(parents=True, exist_ok=True)
+    part_files = []
+    for i, pages_df in enumerate(iter_pages(corpus_file, ["id", "work_id", "text"], source, batch_size)):
+        part_file = part_dir / f"part_{i:05d}.parquet"
+        signatures(pages_df, num_perm, shingle_size).write_parquet(part_file)
+        part_files.append(part_file)
+    if not part_files:
+        # no pages; save an empty table with the signature columns
+        empty_df = pl.DataFrame(schema={"id": pl.String, "work_id": pl.String, "text": pl.String})
+        signatures(empty_df, num_perm, shingle_size).write_parquet(output)
+    else:
+        pl.scan_parquet(part_files).sink_parquet(output)
+    for part_file in part_files:
+        part_file.unlink()
+    part_dir.rmdir()
+    return output
+
+
+def band_keys(signatures_df: pl.LazyFrame, num_perm: int, bands: int) -> pl.LazyFrame:
+    """One row per page and band, with a hash of the band's signature values."""
+    columns = signature_columns(num_perm)
+    rows = num_perm // bands
+    return pl.concat(
+        [
+            signatures_df.select(
+                "id",
+                "work_id",
+                band=pl.lit(band, dtype=pl.UInt16),
+                key=pl.struct(columns[band * rows : (band + 1) * rows]).hash(),
+            )
+            for band in range(bands)
+        ]
+    )
+
+
+def match_signatures(
+    old_df: pl.LazyFrame,
+    new_df: pl.LazyFrame,
+    num_perm: int = DEFAULT_NUM_PERM,
+    bands: int = DEFAULT_BANDS,
+    threshold: float = DEFAULT_THRESHOLD,
+) -> pl.LazyFrame:
+    """Pair pages in the same work with matching values for any band, and
+    keep pairs with an estimated similarity of at least `threshold`."""
+    columns = signature_columns(num_perm)
+    candidates = (
+        band_keys(old_df, num_perm, bands)
+        .join(band_keys(new_df, num_perm, bands), on=["work_id", "band", "key"], suffix="_new")
+        .select("id", "id_new")
+        .unique()
+    )
+    return (
+        candidates.join(old_df, on="id")
+        .join(new_df.drop("work_id"), left_on="id_new", right_on="id", suffix="_new")
+        .select(
+            "work_id",
+            "id",
+            "id_new",
+            similarity=pl.sum_horizontal(pl.col(column) == pl.col(f"{column}_new") for column in columns)
+            / num_perm,
+        )
+        .filter(pl.col("similarity") >= threshold)
+    )
+
+
+def match_pages(
+    old_signatures: pathlib.Path,
+    new_signatures: pathlib.Path,
+    output: pathlib.Path,
+    num_perm: int = DEFAULT_NUM_PERM,
+    bands: int = DEFAULT_BANDS,
+    threshold: float = DEFAULT_THRESHOLD,
+    partitions: int = DEFAULT_PARTITIONS,
+) -> pl.DataFrame:
+    """Match pages between two sets of saved signatures, one group of works
+    at a time, and save the pairs (`work_id`, `id`, `id_new`, `similarity`)
+    to Parquet. Returns all pairs."""
+    if num_perm % bands:
+        raise ValueError(f"Number of bands ({bands}) must divide the signature size ({num_perm})")
+    pairs = []
+    for partition in range(partitions):
+        in_partition = pl.col("work_id").hash() % partitions == partition
+        pairs.append(
+            match_signatures(
+                pl.scan_parquet(old_signatures).filter(in_partition),
+                pl.scan_parquet(new_signatures).filter(in_partition),
+                num_perm,
+                bands,
+                threshold,
+            ).collect()
+        )
+    pairs_df = pl.concat(pairs).sort("work_id", "id", pl.col("similarity"), descending=[False, False, True])
+    pairs_df.write_parquet(output)
+    return pairs_df
+
+
+def main(
+    old_corpus: pathlib.Path,
+    new_corpus: pathlib.Path,
+    output: pathlib.Path,
+    source: str | None = "HathiTrust",
+    num_perm: int = DEFAULT_NUM_PERM,
+    bands: int = DEFAULT_BANDS,
+    shingle_size: int = DEFAULT_SHINGLE_SIZE,
+    threshold: float = DEFAULT_THRESHOLD,
+    partitions: int = DEFAULT_PARTITIONS,
+):
+    with tempfile.TemporaryDirectory(dir=output.parent) as tmp_dir:
+        signature_files = []
+        for name, corpus_file in [("old", old_corpus), ("new", new_corpus)]:
+            print(f"Computing page signatures for {corpus_file}")
+            signature_files.append(
+                corpus_signatures(
+                    corpus_file, pathlib.Path(tmp_dir) / f"{name}.parquet", source, num_perm, shingle_size
+                )
+            )
+        pairs_df = match_pages(*signature_files, output, num_perm, bands, threshold, partitions)
+
+    best_df = pairs_df.group_by("id").agg(pl.col("similarity").max())
+    print(f"{pairs_df.height:,} page pairs with similarity of at least {threshold}; saved to {output}")
+    print(f"{best_df.filter(pl.col('similarity') == 1).height:,} old pages with an identical match")
+    print(f"{best_df.filter(pl.col('similarity') < 1).height:,} old pages with a near-duplicate only")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Match near-duplicate pages between two PPA corpus exports")
+    parser.add_argument("old_corpus", type=pathlib.Path, help="Earlier corpus export (ppa_pages.jsonl.gz)")
+    parser.add_argument("new_corpus", type=pathlib.Path, help="Later corpus export (ppa_pages.jsonl.gz)")
+    parser.add_argument("-o", "--output", type=pathlib.Path, required=True, help="Output Parquet file for page pairs")
+    parser.add_argument(
+        "--source", default="HathiTrust", help="Only match pages from this source (default: %(default)s)"
+    )
+    parser.add_argument("--num-perm", type=int, default=DEFAULT_NUM_PERM, help="Signature size (default: %(default)s)")
+    parser.add_argument("--bands", type=int, default=DEFAULT_BANDS, help="Number of LSH bands (default: %(default)s)")
+    parser.add_argument(
+        "--shingle-size", type=int, default=DEFAULT_SHINGLE_SIZE, help="Words per shingle (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--threshold", type=float, default=DEFAULT_THRESHOLD,
+        help="Minimum similarity to report (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--partitions", type=int, default=DEFAULT_PARTITIONS,
+        help="Number of groups of works to match separately (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    main(
+        args.old_corpus, args.new_corpus, args.output, args.source, args.num_perm, args.bands,
+        args.shingle_size, args.threshold, args.partitions,
+    )
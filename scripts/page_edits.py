@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Measure how much the text changed for pages that are in two versions of
+the PPA page corpus but whose text differs, at the character and word
+(token) level.
+
+For each changed page, the following are computed with rapidfuzz:
+`edit_distance` (Levenshtein distance between the two texts, in
+characters), `similarity` (1 minus the number of characters inserted
+and deleted over the total length of both texts, as in `difflib`'s
+ratio), `inserted_chars` and `deleted_chars` (with substitutions counted
+as one of each), `old_tokens` and `new_tokens` (number of words), and
+`token_distance` and `token_change_rate` (Levenshtein distance between
+the word sequences, and the same over the longer sequence, so 0 is
+unchanged and 1 is entirely different).
+
+Changed pages are found by comparing text hashes (see `ppa_corpus.py`),
+then only their text is read from each export and saved. The pairs are
+split into groups of pages (to limit memory use) and each group into
+chunks that are processed by a pool of worker processes. Results are
+saved to Parquet, one row per page with its `work_id`, so they can be
+summarized by work (see `work_summary`).
+
+Run as a script to compute edit statistics for two corpus exports.
+"""
+
+import argparse
+import os
+import pathlib
+import re
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import polars as pl
+from rapidfuzz.distance import Indel, Levenshtein
+
+from ppa_corpus import iter_pages, read_pages
+
+#: types for the edit statistics for each page
+EDITS_SCHEMA = {
+    "id": pl.String,
+    "edit_distance": pl.Int64,
+    "similarity": pl.Float64,
+    "inserted_chars": pl.Int64,
+    "deleted_chars": pl.Int64,
+    "old_tokens": pl.Int64,
+    "new_tokens": pl.Int64,
+    "token_distance": pl.Int64,
+    "token_change_rate": pl.Float64,
+}
+
+#: words, for token-level changes
+TOKEN_PATTERN = re.compile(r"\w+")
+
+#: number of page pairs sent to a worker at once
+DEFAULT_CHUNK_SIZE = 2_000
+#: number of groups of pages compared separately, to limit memory use
+DEFAULT_PARTITIONS = 16
+
+DEFAULT_WORKERS = os.cpu_count() or 1
+
+
+def chunk_edits(chunk: tuple[list[str], list[str | None], list[str | None]]) -> dict[str, list]:
+    """Edit statistics for a chunk of page pairs, given as lists of page
+    ids, old texts, and new texts; returns a dict of columns."""
+    stats = {column: [] for column in EDITS_SCHEMA}
+    for page_id, old_text, new_text in zip(*chunk):
+        old_text = old_text or ""
+        new_text = new_text or ""
+        # indel distance counts a substitution as one insertion and one deletion,
+        # so the number of each follows from the distance and the change in length
+        indel_distance = Indel.distance(old_text, new_text)
+        length_change = len(new_text) - len(old_text)
+        total_length = len(old_text) + len(new_text)
+        old_tokens = TOKEN_PATTERN.findall(old_text)
+        new_tokens = TOKEN_PATTERN.findall(new_text)
+        token_distance = Levenshtein.distance(old_tokens, new_tokens)
+
+        stats["id"].append(page_id)
+        stats["edit_distance"].append(Levenshtein.distance(old_text, new_text))
+        stats["similarity"].append(1 - indel_distance / total_length if total_length else 1.0)
+        stats["inserted_chars"].append((indel_distance + length_change) // 2)
+        stats["deleted_chars"].append((indel_distance - length_change) // 2)
+        stats["old_tokens"].append(len(old_tokens))
+        stats["new_tokens"].append(len(new_tokens))
+        stats["token_distance"].append(token_distance)
+        stats["token_change_rate"].append(token_distance / max(len(old_tokens), len(new_tokens), 1))
+    return stats
+
+
+def changed_pages(old_corpus: pathlib.Path, new_corpus: pathlib.Path, source: str | None = "HathiTrust") -> pl.DataFrame:
+    """Pages (`id`, `work_id`) in both corpus exports whose text differs;
+    pages with no text in either version are left out, as in the notebook."""
+    old_df, new_df = (
+        read_pages(corpus_file, columns=["id", "work_id"], source=source, hash_bits=64)
+        for corpus_file in [old_corpus, new_corpus]
+    )
+    return (
+        old_df.join(new_df.select("id", "text_hash"), on="id", suffix="_new")
+        .filter(pl.col("text_hash") != pl.col("text_hash_new"))
+        .select("id", "work_id")
+    )
+
+
+def save_texts(corpus_file: pathlib.Path, page_ids: pl.Series, output: pathlib.Path) -> pathlib.Path:
+    """Save the text of the given pages from a corpus export to Parquet,
+    reading the export in batches."""
+    part_dir = output.with_name(f"{output.name}.parts")
+    part_dir.mkdir(parents=True, exist_ok=True)
+    part_files = []
+    for i, pages_df in enumerate(iter_pages(corpus_file, ["id", "text"])):
+        part_file = part_dir / f"part_{i:05d}.parquet"
+        pages_df.filter(pl.col("id").is_in(page_ids.implode())).write_parquet(part_file)
+        part_files.append(part_file)
+    pl.scan_parquet(part_files).sink_parquet(output)
+    for part_file in part_files:
+        part_file.unlink()
+    part_dir.rmdir()
+    return output
+
+
+def compute_edits(
+    old_corpus: pathlib.Path,
+    new_corpus: pathlib.Path,
+    pages_df: pl.DataFrame,
+    output: pathlib.Path,
+    workers: int = DEFAULT_WORKERS,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    partitions: int = DEFAULT_PARTITIONS,
+) -> pathlib.Path:
+    """Compute edit statistics for pages (`id`, `work_id`) whose text
+    changed between two corpus exports, and save them to Parquet."""
+    with tempfile.TemporaryDirectory(dir=output.parent) as tmp_dir:
+        text_files = [
+            save_texts(corpus_file, pages_df["id"], pathlib.Path(tmp_dir) / f"{name}.parquet")
+            for name, corpus_file in [("old", old_corpus), ("new", new_corpus)]
+        ]
+        pairs = pl.scan_parquet(text_files[0]).join(pl.scan_parquet(text_files[1]), on="id", suffix="_new")
+
+        part_files = []
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as executor:
+            for partition in range(partitions):
+                pairs_df = pairs.filter(pl.col("id").hash() % partitions == partition).collect()
+                chunks = (
+                    (chunk_df["id"].to_list(), chunk_df["text"].to_list(), chunk_df["text_new"].to_list())
+                    for chunk_df in pairs_df.iter_slices(chunk_size)
+                )
+                edits_df = pl.concat(
+                    [pl.DataFrame(stats, schema=EDITS_SCHEMA) for stats in executor.map(chunk_edits, chunks)]
+                    or [pl.DataFrame(schema=EDITS_SCHEMA)]
+                )
+                part_file = pathlib.Path(tmp_dir) / f"edits_{partition:05d}.parquet"
+                edits_df.write_parquet(part_file)
+                part_files.append(part_file)
+
+        pl.scan_parquet(part_files).join(pages_df.lazy(), on="id").select("work_id", *EDITS_SCHEMA).sort(
+            "work_id", "id"
+        ).sink_parquet(output)
+    return output
+
+
+def work_summary(edits: pl.LazyFrame) -> pl.LazyFrame:
+    """Edit statistics by work: number of changed pages, their mean and
+    lowest similarity, total characters inserted and deleted, and the
+    token change rate over all changed pages."""
+    return (
+        edits.group_by("work_id")
+        .agg(
+            changed_pages=pl.len(),
+            mean_similarity=pl.col("similarity").mean(),
+            min_similarity=pl.col("similarity").min(),
+            inserted_chars=pl.col("inserted_chars").sum(),
+            deleted_chars=pl.col("deleted_chars").sum(),
+            token_change_rate=pl.col("token_distance").sum()
+            / pl.max_horizontal(pl.col("old_tokens").sum(), pl.col("new_tokens").sum(), 1),
+        )
+        .sort("work_id")
+    )
+
+
+def main(
+    old_corpus: pathlib.Path,
+    new_corpus: pathlib.Path,
+    output: pathlib.Path,
+    summary: pathlib.Path | None = None,
+    source: str | None = "HathiTrust",
+    workers: int = DEFAULT_WORKERS,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    partitions: int = DEFAULT_PARTITIONS,
+):
+    print("Finding changed pages")
+    pages_df = changed_pages(old_corpus, new_corpus, source)
+    print(f"{pages_df.height:,} pages with changed text")
+    compute_edits(old_corpus, new_corpus, pages_df, output, workers, chunk_size, partitions)
+    print(f"Saved edit statistics to {output}")
+
+    summary_df = work_summary(pl.scan_parquet(output)).collect()
+    if summary:
+        summary_df.write_csv(summary)
+        print(f"Saved summary for {summary_df.height:,} works to {summary}")
+    print(summary_df)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute edit statistics for pages changed between two PPA corpus exports")
+    parser.add_argument("old_corpus", type=pathlib.Path, help="Earlier corpus export (ppa_pages.jsonl.gz)")
+    parser.add_argument("new_corpus", type=pathlib.Path, help="Later corpus export (ppa_pages.jsonl.gz)")
+    parser.add_argument("-o", "--output", type=pathlib.Path, required=True, help="Output Parquet file for page statistics")
+    parser.add_argument("--summary", type=pathlib.Path, help="Save a summary by work to CSV")
+    parser.add_argument(
+        "--source", default="HathiTrust", help="Only compare pages from this source (default: %(default)s)"
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=DEFAULT_WORKERS,
+        help="Number of worker processes (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+        help="Number of page pairs sent to a worker at once (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--partitions", type=int, default=DEFAULT_PARTITIONS,
+        help="Number of groups of pages compared separately (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    main(
+        args.old_corpus, args.new_corpus, args.output, args.summary, args.source, args.workers,
+        args.chunk_size, args.partitions,
+    )
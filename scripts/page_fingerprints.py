@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+Store of page fingerprints for PPA corpus exports, so versions of the
+corpus can be compared (two at a time, or across every export) without
+keeping the full exports or reading page text again.
+
+Each export is read once (see `ppa_corpus.py`) and saved as a Parquet
+table with one row per page: `id`, `work_id`, `source`, `order`,
+`text_hash`, `text_length` (in characters), and `empty` (text is null or
+only whitespace). Tables are named for the export directory, e.g.
+`ppa_corpus_2025-02-19.parquet`, and listed in a manifest with the hash
+settings used, since only fingerprints with the same settings can be compared.
+
+Run as a script to add exports to the store, compare two snapshots, or
+summarize page changes between each consecutive pair of snapshots.
+"""
+
+import argparse
+import datetime
+import json
+import pathlib
+import tempfile
+
+import polars as pl
+
+from ppa_corpus import DEFAULT_BATCH_SIZE, iter_pages, work_source
+
+STORE_DIR = pathlib.Path(__file__).parent.parent.resolve() / "data" / "ppa" / "fingerprints"
+
+MANIFEST_FILENAME = "fingerprints.json"
+
+#: page status when comparing two snapshots
+PAGE_STATUS = pl.Enum(["unchanged", "changed", "added", "removed"])
+
+
+def load_manifest(store_dir: pathlib.Path = STORE_DIR) -> dict:
+    """Load the list of snapshots in the store, with their hash settings."""
+    manifest_file = store_dir / MANIFEST_FILENAME
+    if manifest_file.exists():
+        return json.loads(manifest_file.read_text())
+    return {}
+
+
+def save_manifest(manifest: dict, store_dir: pathlib.Path = STORE_DIR):
+    manifest_file = store_dir / MANIFEST_FILENAME
+    tmp_file = manifest_file.with_name(f"{manifest_file.name}.tmp")
+    tmp_file.write_text(json.dumps(dict(sorted(manifest.items())), indent=2))
+    tmp_file.replace(manifest_file)
+
+
+def snapshot_name(corpus_file: pathlib.Path) -> str:
+    """Name for the snapshot of a corpus export: the export directory name,
+    e.g. `ppa_corpus_2025-02-19/ppa_pages.jsonl.gz` → `ppa_corpus_2025-02-19`."""
+    return corpus_file.parent.name
+
+
+def add_snapshot(
+    corpus_file: pathlib.Path,
+    name: str | None = None,
+    store_dir: pathlib.Path = STORE_DIR,
+    hash_bits: int = 64,
+    normalize: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+) -> pathlib.Path:
+    """Fingerprint every page in a corpus export and save the table to the
+    store. Pages are read and fingerprinted in batches, so the export is
+    never loaded in full."""
+    name = name or snapshot_name(corpus_file)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    fingerprint_file = store_dir / f"{name}.parquet"
+    pages = iter_pages(
+        corpus_file, ["id", "work_id", "order", "text"], batch_size=batch_size, hash_bits=hash_bits, normalize=normalize
+    )
+    with tempfile.TemporaryDirectory(dir=store_dir) as tmp_dir:
+        part_files = []
+        for i, pages_df in enumerate(pages):
+            part_file = pathlib.Path(tmp_dir) / f"part_{i:05d}.parquet"
+            pages_df.select(
+                "id",
+                "work_id",
+                source=work_source(),
+                order="order",
+                text_hash="text_hash",
+                text_length=pl.col("text").str.len_chars().fill_null(0).cast(pl.UInt32),
+                empty="empty",
+            ).write_parquet(part_file)
+            part_files.append(part_file)
+
+        tmp_file = fingerprint_file.with_name(f"{fingerprint_file.name}.tmp")
+        pl.scan_parquet(part_files).sort("work_id", "order").sink_parquet(
+            tmp_file, compression="zstd", statistics=True
+        )
+        tmp_file.replace(fingerprint_file)
+
+    manifest = load_manifest(store_dir)
+    manifest[name] = {
+        "source": str(corpus_file),
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "hash_bits": hash_bits,
+        "normalize": normalize,
+        "pages": pl.scan_parquet(fingerprint_file).select(pl.len()).collect().item(),
+    }
+    save_manifest(manifest, store_dir)
+    return fingerprint_file
+
+
+def scan_snapshot(name: str, store_dir: pathlib.Path = STORE_DIR) -> pl.LazyFrame:
+    """Lazily load the page fingerprints for one snapshot."""
+    if name not in load_manifest(store_dir):
+        raise ValueError(f"No snapshot {name} in {store_dir}")
+    return pl.scan_parquet(store_dir / f"{name}.parquet")
+
+
+def scan_snapshots(names: list[str] | None = None, store_dir: pathlib.Path = STORE_DIR) -> pl.LazyFrame:
+    """Lazily load the page fingerprints for several snapshots (default all)
+    as one table, with a `snapshot` column, for questions across all
+    versions such as how many times each page has changed."""
+    names = names or sorted(load_manifest(store_dir))
+    check_comparable(names, store_dir)
+    return pl.concat(
+        [scan_snapshot(name, store_dir).with_columns(snapshot=pl.lit(name, dtype=pl.Enum(names))) for name in names]
+    )
+
+
+def check_comparable(names: list[str], store_dir: pathlib.Path = STORE_DIR):
+    """Make sure snapshots were fingerprinted with the same hash settings."""
+    manifest = load_manifest(store_dir)
+    settings = {(manifest[name]["hash_bits"], manifest[name]["normalize"]) for name in names}
+    if len(settings) > 1:
+        raise ValueError(f"Snapshots {', '.join(names)} were fingerprinted with different hash settings")
+
+
+def compare(old: str, new: str, store_dir: pathlib.Path = STORE_DIR) -> pl.LazyFrame:
+    """Compare two snapshots by page id: each page is unchanged, changed
+    (different text hash; pages without text in both are unchanged),
+    added, or removed."""
+    check_comparable([old, new], store_dir)
+    return (
+        scan_snapshot(old, store_dir)
+        .join(scan_snapshot(new, store_dir), on="id", how="full", coalesce=True, suffix="_new")
+        .with_columns(
+            status=pl.when(pl.col("work_id").is_null())
+            .then(pl.lit("added"))
+            .when(pl.col("work_id_new").is_null())
+            .then(pl.lit("removed"))
+            .when(pl.col("text_hash").eq_missing(pl.col("text_hash_new")))
+            .then(pl.lit("unchanged"))
+            .otherwise(pl.lit("changed"))
+            .cast(PAGE_STATUS)
+        )
+    )
+
+
+def timeline(names: list[str] | None = None, store_dir: pathlib.Path = STORE_DIR) -> pl.DataFrame:
+    """Number of pages unchanged, changed, added, and removed between each
+    consecutive pair of snapshots (default all snapshots, in name order,
+    which is date order for export directory names)."""
+    names = names or sorted(load_manifest(store_dir))
+    check_comparable(names, store_dir)
+    counts = [
+        compare(old, new, store_dir).select(
+            old=pl.lit(old),
+            new=pl.lit(new),
+            **{status: (pl.col("status") == status).sum() for status in PAGE_STATUS.categories},
+        )
+        for old, new in zip(names, names[1:])
+    ]
+    return pl.concat(counts).collect() if counts else pl.DataFrame()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fingerprint PPA corpus exports and compare them over time")
+    parser.add_argument(
+        "--store-dir", type=pathlib.Path, default=STORE_DIR, help="Fingerprint store (default: %(default)s)"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    add_parser = subparsers.add_parser("add", help="Add corpus exports to the store")
+    add_parser.add_argument("corpus_files", type=pathlib.Path, nargs="+", help="Corpus exports (ppa_pages.jsonl.gz)")
+    add_parser.add_argument("--name", help="Snapshot name, when adding one export (default: export directory name)")
+    add_parser.add_argument("--hash-bits", type=int, choices=[64, 128], default=64)
+    add_parser.add_argument("--normalize", action="store_true", help="Normalize whitespace before hashing")
+    subparsers.add_parser("list", help="List snapshots in the store")
+    compare_parser = subparsers.add_parser("compare", help="Compare two snapshots page by page")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("-o", "--output", type=pathlib.Path, help="Save page-level results to Parquet")
+    timeline_parser = subparsers.add_parser("timeline", help="Summarize changes between consecutive snapshots")
+    timeline_parser.add_argument("names", nargs="*", help="Snapshots to compare, in order (default: all)")
+    timeline_parser.add_argument("-o", "--output", type=pathlib.Path, help="Save the summary to CSV")
+    args = parser.parse_args()
+
+    if args.command == "add":
+        if args.name and len(args.corpus_files) > 1:
+            parser.error("--name can only be used when adding one export")
+        for corpus_file in args.corpus_files:
+            fingerprint_file = add_snapshot(corpus_file, args.name, args.store_dir, args.hash_bits, args.normalize)
+            print(f"Saved page fingerprints for {corpus_file} to {fingerprint_file}")
+    elif args.command == "list":
+        for name, info in load_manifest(args.store_dir).items():
+            print(f"{name}\t{info['pages']:,} pages\t{info['hash_bits']}-bit{' normalized' if info['normalize'] else ''}")
+    elif args.command == "compare":
+        comparison_df = compare(args.old, args.new, args.store_dir)
+        if args.output:
+            comparison_df.sink_parquet(args.output)
+        print(comparison_df.group_by("status").len(name="pages").sort("status").collect())
+    elif args.command == "timeline":
+        timeline_df = timeline(args.names, args.store_dir)
+        if args.output:
+            timeline_df.write_csv(args.output)
+        print(timeline_df)
+
+
+if __name__ == "__main__":
+    main()
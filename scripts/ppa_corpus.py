@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+Streaming reader for PPA page-level full-text corpus exports
+(`ppa_pages.jsonl.gz`: one JSON object per page, with `id`, `work_id`,
+`order`, `label`, `tags`, and `text`).
+
+The gzipped file is decompressed and parsed in batches of lines, so a
+full corpus never has to be held in memory as JSON. Only the requested
+columns are parsed into each batch (leaving out `text` avoids
+materializing the page text at all), and the source filter is applied to
+each batch as it is read, so pages from other sources are dropped before
+batches are combined.
+
+Page text can also be reduced to a content hash (BLAKE2b, 64 or 128 bits;
+optionally with whitespace normalized) as each batch is read, so corpus
+versions can be compared by joining on hashes, and the text itself can be
+dropped as soon as it has been hashed. Hashes are stable across sessions
+and polars versions, so they can be saved and compared later. Pages with
+null text have a null hash; empty text is hashed like any other, so an
+`empty` flag (null or only whitespace) is added alongside the hash for
+comparisons that need to leave empty pages out.
+
+A corpus export can also be converted to a Parquet dataset partitioned by
+source and the first characters of the work id (hive layout:
+`ppa_pages/source=HathiTrust/work_id_prefix=md/pages.parquet`), with the
+source of each work taken from the PPA work metadata (or, for works not in
+the metadata, its work id). Reading a converted corpus for one source only
+opens that source's files. The readers here accept either an export or a
+converted dataset directory.
+
+Run as a script to summarize the pages and works in a corpus export by source,
+or to convert an export to a partitioned dataset.
+"""
+
+import argparse
+import functools
+import gzip
+import hashlib
+import io
+import itertools
+import pathlib
+import shutil
+from collections.abc import Iterator
+
+import polars as pl
+
+#: types for the fields in a page record
+PAGE_SCHEMA = {
+    "id": pl.String,
+    "work_id": pl.String,
+    "order": pl.Int64,
+    "label": pl.String,
+    "tags": pl.List(pl.String),
+    "text": pl.String,
+}
+
+#: work id patterns for non-HathiTrust sources; either could have an optional
+#: -p## suffix for excerpt start page
+SOURCE_WORK_IDS = {
+    # EEBO-TCP work id is A followed by numbers
+    "EEBO-TCP": r"^A\d+(-p.+)?$",
+    # Gale/ECCO work id is CW/CB followed by numbers
+    "Gale": r"^C[WB]\d+(-p.+)?$",
+}
+SOURCES = ["HathiTrust", *SOURCE_WORK_IDS]
+
+WORK_METADATA = pathlib.Path(__file__).parent.parent.resolve() / "data" / "ppa" / "ppa_work_metadata.csv"
+
+#: name of a partitioned dataset, saved next to the corpus export
+DATASET_NAME = "ppa_pages"
+#: number of characters of the work id used to partition works within a source
+PREFIX_LENGTH = 2
+
+#: number of pages parsed at once
+DEFAULT_BATCH_SIZE = 50_000
+#: pages per row group in a partitioned dataset; smaller groups let batches be read without reading the whole file
+ROW_GROUP_SIZE = 10_000
+
+#: supported text hash sizes, in bits, and the type of the hash column for each
+HASH_TYPES = {64: pl.UInt64, 128: pl.Binary}
+
+
+def work_source() -> pl.Expr:
+    """Expression for the source of a page, based on its work id."""
+    source = pl.lit("HathiTrust")
+    for name, pattern in SOURCE_WORK_IDS.items():
+        source = pl.when(pl.col("work_id").str.contains(pattern)).then(pl.lit(name)).otherwise(source)
+    return source
+
+
+def load_work_sources(metadata: pathlib.Path = WORK_METADATA) -> pl.DataFrame:
+    """Source of each work (`work_id`, `source`) from PPA work metadata."""
+    return pl.read_csv(metadata, columns=["ppa_work_id", "ppa_source"]).rename(
+        {"ppa_work_id": "work_id", "ppa_source": "source"}
+    )
+
+
+def dataset_path(corpus_file: pathlib.Path) -> pathlib.Path:
+    """Path for the partitioned dataset converted from a corpus export."""
+    return corpus_file.parent / DATASET_NAME
+
+
+def corpus_path(corpus_file: pathlib.Path) -> pathlib.Path:
+    """The partitioned dataset for a corpus export if it has been converted,
+    otherwise the export."""
+    dataset_dir = dataset_path(corpus_file)
+    return dataset_dir if dataset_dir.is_dir() else corpus_file
+
+
+def dataset_files(dataset_dir: pathlib.Path, source: str | None = None) -> list[pathlib.Path]:
+    """Parquet files in a partitioned dataset, for one source or all."""
+    return sorted(dataset_dir.glob(f"source={source or '*'}/work_id_prefix=*/*.parquet"))
+
+
+def hash_texts(texts: pl.Series, bits: int = 64) -> pl.Series:
+    """BLAKE2b hashes for a series of page texts: 64-bit hashes as unsigned
+    integers, 128-bit hashes as 16-byte binary values."""
+    digests = [
+        hashlib.blake2b(text.encode(), digest_size=bits // 8).digest() if text is not None else None
+        for text in texts
+    ]
+    if bits == 64:
+        digests = [int.from_bytes(digest, "little") if digest is not None else None for digest in digests]
+    return pl.Series(texts.name, digests, dtype=HASH_TYPES[bits])
+
+
+def text_hash(column: str = "text", bits: int = 64, normalize: bool = False) -> pl.Expr:
+    """Expression for the content hash of page text; null for pages with null
+    text. With `normalize`, runs of whitespace are collapsed to a single
+    space (and leading and trailing whitespace removed) before hashing, so
+    pages that only differ in spacing or line breaks have the same hash."""
+    if bits not in HASH_TYPES:
+        raise ValueError(f"Unsupported hash size {bits}; expected one of {', '.join(map(str, HASH_TYPES))}")
+    text = pl.col(column)
+    if normalize:
+        text = text.str.replace_all(r"\s+", " ").str.strip_chars()
+    return text.map_batches(functools.partial(hash_texts, bits=bits), return_dtype=HASH_TYPES[bits])
+
+
+def text_empty(column: str = "text") -> pl.Expr:
+    """Expression for whether a page has no text: null, or only whitespace."""
+    return pl.col(column).is_null() | (pl.col(column).str.strip_chars() == "")
+
+
+def iter_pages(
+    corpus_file: pathlib.Path,
+    columns: list[str] | None = None,
+    source: str | None = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    hash_bits: int | None = None,
+    normalize: bool = False,
+) -> Iterator[pl.DataFrame]:
+    """Read a corpus export or dataset in batches of pages, with only the requested
+    columns (default all), and only pages from `source` (one of `SOURCES`)
+    if specified. With `hash_bits`, adds `text_hash` and `empty` columns (see
+    `text_hash` and `text_empty`); text is only kept if it is one of the
+    requested columns."""
+    columns = columns or list(PAGE_SCHEMA)
+    if source is not None and source not in SOURCES:
+        raise ValueError(f"Unknown source {source}; expected one of {', '.join(SOURCES)}")
+    # work id is needed to filter by source, and text to hash it, even if they aren't returned
+    read_columns = list(columns)
+    if source is not None and "work_id" not in read_columns:
+        read_columns.append("work_id")
+    if hash_bits is not None and "text" not in read_columns:
+        read_columns.append("text")
+    output_columns = [*columns, "text_hash", "empty"] if hash_bits is not None else columns
+
+    if corpus_file.is_dir():
+        batches = iter_dataset_batches(corpus_file, read_columns, source, batch_size)
+    else:
+        batches = iter_export_batches(corpus_file, read_columns, source, batch_size)
+    for pages_df in batches:
+        if hash_bits is not None:
+            pages_df = pages_df.with_columns(
+                text_hash=text_hash(bits=hash_bits, normalize=normalize), empty=text_empty()
+            )
+        yield pages_df.select(output_columns)
+
+
+def iter_export_batches(
+    corpus_file: pathlib.Path, columns: list[str], source: str | None, batch_size: int
+) -> Iterator[pl.DataFrame]:
+    """Parse a gzipped corpus export in batches of lines, filtering each batch by source."""
+    schema = {column: PAGE_SCHEMA[column] for column in columns}
+    with gzip.open(corpus_file, "rb") as corpus:
+        while lines := list(itertools.islice(corpus, batch_size)):
+            pages_df = pl.read_ndjson(io.BytesIO(b"".join(lines)), schema=schema)
+            if source is not None:
+                pages_df = pages_df.filter(work_source() == source)
+            yield pages_df
+
+
+def iter_dataset_batches(
+    dataset_dir: pathlib.Path, columns: list[str], source: str | None, batch_size: int
+) -> Iterator[pl.DataFrame]:
+    """Read a partitioned dataset in batches of pages, opening only the files for `source`."""
+    for dataset_file in dataset_files(dataset_dir, source):
+        pages = pl.scan_parquet(dataset_file).select(columns)
+        # each slice only reads the row groups it covers (row counts come from
+        # Parquet metadata), so each page is read once
+        for offset in itertools.count(0, batch_size):
+            pages_df = pages.slice(offset, batch_size).collect()
+            if not pages_df.is_empty():
+                yield pages_df
+            if pages_df.height < batch_size:
+                break
+
+
+def read_pages(
+    corpus_file: pathlib.Path,
+    columns: list[str] | None = None,
+    source: str | None = None,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+    hash_bits: int | None = None,
+    normalize: bool = False,
+) -> pl.DataFrame:
+    """Load a corpus export, reading and filtering it in batches; see `iter_pages`."""
+    batches = list(iter_pages(corpus_file, columns, source, batch_size, hash_bits, normalize))
+    if not batches:
+        schema = {column: PAGE_SCHEMA[column] for column in columns or PAGE_SCHEMA}
+        if hash_bits is not None:
+            schema |= {"text_hash": HASH_TYPES[hash_bits], "empty": pl.Boolean}
+        return pl.DataFrame(schema=schema)
+    return pl.concat(batches, rechunk=True)
+
+
+def scan_dataset(dataset_dir: pathlib.Path, source: str | None = None) -> pl.LazyFrame:
+    """Lazily load a partitioned dataset, for one source or all, with the
+    `source` and `work_id_prefix` partition columns."""
+    return pl.scan_parquet(
+        dataset_files(dataset_dir, source),
+        hive_partitioning=True,
+        hive_schema={"source": pl.String, "work_id_prefix": pl.String},
+    )
+
+
+def export_dataset(
+    corpus_file: pathlib.Path,
+    dataset_dir: pathlib.Path | None = None,
+    metadata: pathlib.Path = WORK_METADATA,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+) -> pathlib.Path:
+    """Convert a corpus export to a Parquet dataset partitioned by source
+    and work id prefix (default `ppa_pages` next to the export). Each work's
+    source is looked up once, so pages are never classified individually."""
+    dataset_dir = dataset_dir or dataset_path(corpus_file)
+    work_sources = load_work_sources(metadata)
+    tmp_dir = dataset_dir.with_name(f"{dataset_dir.name}.tmp")
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+
+    partition_dirs = set()
+    for i, pages_df in enumerate(iter_export_batches(corpus_file, list(PAGE_SCHEMA), None, batch_size)):
+        # works that aren't in the metadata are classified by work id, once each
+        new_works = pages_df.select("work_id").unique().join(work_sources, on="work_id", how="anti")
+        if not new_works.is_empty():
+            work_sources = pl.concat([work_sources, new_works.with_columns(source=work_source())])
+        pages_df = pages_df.join(work_sources, on="work_id", how="left").with_columns(
+            work_id_prefix=pl.col("work_id").str.slice(0, PREFIX_LENGTH)
+        )
+        for (source, prefix), partition_df in pages_df.partition_by("source", "work_id_prefix", as_dict=True).items():
+            partition_dir = tmp_dir / f"source={source}" / f"work_id_prefix={prefix}"
+            partition_dir.mkdir(parents=True, exist_ok=True)
+            partition_df.drop("source", "work_id_prefix").write_parquet(partition_dir / f"part_{i:05d}.parquet")
+            partition_dirs.add(partition_dir)
+
+    # combine the batches for each partition into one file, in page order
+    for partition_dir in partition_dirs:
+        part_files = sorted(partition_dir.glob("part_*.parquet"))
+        pl.scan_parquet(part_files).sort("work_id", "order").sink_parquet(
+            partition_dir / "pages.parquet", compression="zstd", statistics=True, row_group_size=ROW_GROUP_SIZE
+        )
+        for part_file in part_files:
+            part_file.unlink()
+
+    if dataset_dir.exists():
+        shutil.rmtree(dataset_dir)
+    tmp_dir.replace(dataset_dir)
+    return dataset_dir
+
+
+def main(corpus_file: pathlib.Path, batch_size: int = DEFAULT_BATCH_SIZE):
+    summaries = [
+        pages_df.with_columns(source=work_source()).group_by("source", "work_id").len(name="pages")
+        for pages_df in iter_pages(corpus_file, ["work_id"], batch_size=batch_size)
+    ]
+    summary_df = (
+        pl.concat(summaries)
+        .group_by("source", "work_id")
+        .agg(pl.col("pages").sum())
+        .group_by("source")
+        .agg(works=pl.len(), pages=pl.col("pages").sum())
+        .sort("source")
+    )
+    print(summary_df)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize a PPA page corpus export by source")
+    parser.add_argument(
+        "corpus", help="Corpus export (ppa_pages.jsonl.gz) or partitioned dataset directory", type=pathlib.Path
+    )
+    parser.add_argument(
+        "--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+        help="Number of pages to read at once (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--export", action="store_true",
+        help=f"Convert the export to a dataset partitioned by source, saved as {DATASET_NAME} next to it",
+    )
+    parser.add_argument(
+        "--metadata", type=pathlib.Path, default=WORK_METADATA,
+        help="PPA work metadata, for the source of each work (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    if args.export:
+        dataset_dir = export_dataset(args.corpus, metadata=args.metadata, batch_size=args.batch_size)
+        print(f"Saved partitioned corpus to {dataset_dir}")
+        args.corpus = dataset_dir
+    main(args.corpus, args.batch_size)
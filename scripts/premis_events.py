@@ -4,9 +4,12 @@ import argparse
 import csv
 import pathlib
 
+import polars as pl
 from neuxml import xmlmap
 from neuxml.xmlmap import premis as PREMIS
 
+import htid_keys
+
 
 class MetsPremis(xmlmap.XmlObject):
     ROOT_NAMESPACES = {
@@ -18,7 +21,7 @@ class MetsPremis(xmlmap.XmlObject):
     )
 
 
-def main(mets_dir, output):
+def main(mets_dir, output, keys=False):
     with output.open("w") as outfile:
         fieldnames = ["htid", "event_type", "date", "detail", "filename"]
         csvwriter = csv.DictWriter(outfile, fieldnames=fieldnames)
@@ -37,6 +40,11 @@ def main(mets_dir, output):
                     }
                 )
 
+    if keys:
+        # add the shared integer key for each htid, for joining with other datasets
+        events_df = htid_keys.add_keys(pl.read_csv(output, infer_schema=False))
+        events_df.write_csv(output)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -46,6 +54,9 @@ if __name__ == "__main__":
         "dir", help="Directory containing mets.xml files", type=pathlib.Path
     )
     parser.add_argument("output", help="Output file", type=pathlib.Path)
+    parser.add_argument(
+        "--keys", help="Include the shared integer key for each htid", action="store_true"
+    )
     args = parser.parse_args()
 
-    main(args.dir, args.output)
+    main(args.dir, args.output, args.keys)
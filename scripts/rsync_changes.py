@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Build a table of changed files from the output of `rsync --itemize-changes`
+for a pairtree copy of HathiTrust data, as the sync runs.
+
+Each itemized line starts with an 11-character string of change flags
+(`YXcstpoguax`: update type, file type, then one position per attribute,
+with `+` for new files), e.g. `>f.st...... mdp/pairtree_root/.../39015012345678.zip`.
+Lines for files (and deleted files) in pairtree directories are kept, and
+the rest of the output (directories, summary lines) is skipped. Lines
+written with `--log-file`, which start with a timestamp and process id,
+are also recognized.
+
+Input is read from a file (optionally gzipped) or stdin a batch of lines at
+a time, and each batch is parsed with polars and appended to the output CSV
+(`htid`, `filename`, `size_changed`, `modification_time`, `rsync_flags`)
+as soon as it is read, so memory use is bounded by the batch size and the
+table is complete when rsync finishes. New files count as changed in size
+and modification time.
+
+Example, with the change table written alongside the sync:
+
+    rsync -av --itemize-changes [source] [dest] | tee rsync.log | python ./scripts/rsync_changes.py
+"""
+
+import argparse
+import datetime
+import gzip
+import io
+import itertools
+import pathlib
+import sys
+from collections.abc import Iterable, Iterator
+from typing import TextIO
+
+import polars as pl
+
+import htid_keys
+from htid_paths import path_htid
+
+OUTPUT_DIR = pathlib.Path(__file__).parent.parent.resolve() / "data" / "ppa"
+
+#: itemized change line, optionally with the timestamp and pid prefix used in rsync log files
+ITEMIZED_LINE = (
+    r"^(?:\d{4}/\d\d/\d\d \d\d:\d\d:\d\d \[\d+\] )?"
+    r"(?P<rsync_flags>\*deleting|[<>ch.][fdLDS].{9}) +(?P<path>.+)$"
+)
+
+CHANGES_SCHEMA = {
+    "htid": pl.String,
+    "filename": pl.String,
+    "size_changed": pl.Boolean,
+    "modification_time": pl.Boolean,
+    "rsync_flags": pl.String,
+}
+
+#: number of lines parsed at once
+DEFAULT_BATCH_SIZE = 10_000
+
+
+def default_output() -> pathlib.Path:
+    """Output file named for the time the sync ran, as for the existing change tables."""
+    return OUTPUT_DIR / f"ppa_rsync_changes_{datetime.datetime.now():%Y%m%d-%H%M%S}.csv"
+
+
+def parse_changes(lines: list[str]) -> pl.DataFrame:
+    """Parse itemized change lines into the change table; lines that are not
+    for files in a pairtree directory are dropped."""
+    flags = pl.col("rsync_flags")
+    # new files have + for every attribute
+    new_file = flags.str.slice(2).str.contains(r"^\++$")
+    return (
+        pl.DataFrame({"line": lines}, schema={"line": pl.String})
+        .select(pl.col("line").str.strip_chars_end("\r\n").str.extract_groups(ITEMIZED_LINE))
+        .unnest("line")
+        .filter(
+            (flags.str.slice(1, 1) == "f") | (flags == "*deleting"),
+            pl.col("path").str.contains("/pairtree_root/", literal=True),
+            ~pl.col("path").str.ends_with("/"),
+        )
+        .select(
+            htid=path_htid(pl.col("path")),
+            filename=pl.col("path").str.extract(r"([^/]+)$"),
+            size_changed=new_file | (flags.str.slice(3, 1) == "s"),
+            modification_time=new_file | flags.str.slice(4, 1).is_in(["t", "T"]),
+            rsync_flags=flags,
+        )
+    )
+
+
+def format_booleans(changes_df: pl.DataFrame) -> pl.DataFrame:
+    """Write booleans as True/False, as in the existing change tables,
+    rather than the lowercase polars uses."""
+    return changes_df.with_columns(
+        pl.col(pl.Boolean).replace_strict({True: "True", False: "False"}, return_dtype=pl.String)
+    )
+
+
+def iter_changes(lines: Iterable[str], batch_size: int = DEFAULT_BATCH_SIZE) -> Iterator[pl.DataFrame]:
+    """Parse rsync output a batch of lines at a time, yielding the changes in each batch."""
+    lines = iter(lines)
+    while batch := list(itertools.islice(lines, batch_size)):
+        yield parse_changes(batch)
+
+
+def open_log(log_file: pathlib.Path | None) -> TextIO:
+    """Open an rsync log file, or stdin if none is given."""
+    if log_file is None or str(log_file) == "-":
+        return io.TextIOWrapper(sys.stdin.buffer, errors="replace")
+    if log_file.suffix == ".gz":
+        return gzip.open(log_file, "rt", errors="replace")
+    return log_file.open(errors="replace")
+
+
+def main(
+    log_file: pathlib.Path | None,
+    output: pathlib.Path,
+    keys: bool = False,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+):
+    total = 0
+    with open_log(log_file) as log, output.open("w") as outfile:
+        for changes_df in iter_changes(log, batch_size):
+            if changes_df.is_empty():
+                continue
+            if keys:
+                changes_df = htid_keys.add_keys(changes_df)
+            format_booleans(changes_df).write_csv(outfile, include_header=total == 0)
+            outfile.flush()
+            total += changes_df.height
+        if total == 0:
+            # write the header, so the table can be loaded even with no changes
+            changes_df = pl.DataFrame(schema=CHANGES_SCHEMA)
+            format_booleans(htid_keys.add_keys(changes_df) if keys else changes_df).write_csv(outfile)
+    print(f"Saved {total:,} changed files to {output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Parse rsync --itemize-changes output for HathiTrust pairtree data into a change table"
+    )
+    parser.add_argument(
+        "log", type=pathlib.Path, nargs="?", help="rsync output or log file, optionally gzipped (default: stdin)"
+    )
+    parser.add_argument(
+        "-o", "--output", type=pathlib.Path,
+        help="Output CSV file (default: ppa_rsync_changes_[timestamp].csv in data/ppa)",
+    )
+    parser.add_argument("--keys", help="Include the shared integer key for each htid", action="store_true")
+    parser.add_argument(
+        "--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+        help="Number of lines to parse at once (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    main(args.log, args.output or default_output(), args.keys, args.batch_size)